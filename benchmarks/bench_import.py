@@ -0,0 +1,67 @@
+"""
+Cold start import benchmark for pypsi.
+Imports the package in fresh interpreters, reports the median import time and fails
+if it exceeds the budget or if one of the deferred heavy dependencies got imported.
+
+usage: python benchmarks/bench_import.py [--budget 0.5] [--repeats 7]
+"""
+import argparse
+import json
+import os
+import pathlib as plib
+import statistics
+import subprocess
+import sys
+
+ROOT = plib.Path(__file__).absolute().parent.parent
+MODULES = ["pypsi", "pypsi.parameters"]
+DEFERRED = ["pandas", "plotly"]
+
+_SNIPPET = """
+import json, sys, time
+t_start = time.perf_counter()
+import {module}
+t_import = time.perf_counter() - t_start
+loaded = sorted(m for m in {deferred} if m in sys.modules)
+print(json.dumps({{"time": t_import, "loaded": loaded}}))
+"""
+
+
+def time_import(module: str, repeats: int) -> dict:
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT.as_posix(), env.get("PYTHONPATH")]))
+    times = []
+    loaded = set()
+    for _ in range(repeats):
+        out = subprocess.run(
+            [sys.executable, "-c", _SNIPPET.format(module=module, deferred=DEFERRED)],
+            env=env, capture_output=True, text=True, check=True
+        )
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        times.append(result["time"])
+        loaded.update(result["loaded"])
+    return {"module": module, "median_s": statistics.median(times), "min_s": min(times), "loaded": sorted(loaded)}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_import")
+    parser.add_argument("--budget", type=float, default=0.5, help="cold start budget per module in seconds")
+    parser.add_argument("--repeats", type=int, default=7)
+    args = parser.parse_args()
+
+    failed = False
+    for module in MODULES:
+        result = time_import(module, repeats=args.repeats)
+        status = "ok"
+        if result["median_s"] > args.budget:
+            status = f"over budget ({args.budget:.3f} s)"
+            failed = True
+        if result["loaded"]:
+            status = f"imported deferred dependencies {result['loaded']}"
+            failed = True
+        print(f"{module:<20} median {result['median_s'] * 1e3:8.1f} ms  min {result['min_s'] * 1e3:8.1f} ms  {status}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""
+Benchmark suite of the pypsi hot paths on synthetic protocols.
+Every case is timed (median of repeats) and its peak python heap allocation is traced in an extra run.
+Results are written as json, comparing against a stored result flags regressions.
+
+usage: python benchmarks/bench_pypsi.py [--scale small|medium|large] [--repeats 3] [--cases ...]
+                                         [--output <file.json>] [--baseline <file.json>] [--tolerance 0.25]
+"""
+import argparse
+import gc
+import json
+import logging
+import pathlib as plib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+
+import numpy as np
+
+ROOT = plib.Path(__file__).absolute().parent.parent
+sys.path.insert(0, ROOT.as_posix())
+
+from bench_import import time_import  # noqa: E402
+from pypsi.config import Config, Params, XConfig, load_file  # noqa: E402
+from pypsi.parameters.rf_params import RFPulse  # noqa: E402
+
+SCALES: typing.Dict[str, dict] = {
+    "small": {"scans": 10_000, "trajectories": 16, "trajectory_samples": 512, "pulse_samples": 2_000},
+    "medium": {"scans": 200_000, "trajectories": 128, "trajectory_samples": 1024, "pulse_samples": 20_000},
+    "large": {"scans": 2_000_000, "trajectories": 1024, "trajectory_samples": 2048, "pulse_samples": 200_000},
+}
+RASTER_TIME_S: float = 1e-6
+
+
+def synthetic_entries(num_scans: int, seed: int = 0) -> typing.Dict[str, np.ndarray]:
+    """
+    Sampling pattern columns of a multi echo, multi slice protocol with navigators.
+    """
+    rng = np.random.default_rng(seed)
+    scan_num = np.arange(num_scans)
+    return {
+        "scan_num": scan_num, "slice_num": scan_num % 36, "pe_num": rng.integers(0, 256, num_scans),
+        "echo_num": scan_num % 8, "acq_type": np.where(scan_num % 50 == 0, "nav", "img"),
+        "echo_type": np.where(scan_num % 2 == 0, "se", "gre"), "echo_type_num": scan_num % 4,
+        "nav_acq": scan_num % 50 == 0
+    }
+
+
+def synthetic_trajectories(num: int, num_samples: int) -> typing.Dict[str, np.ndarray]:
+    k = np.linspace(-0.5, 0.5, num_samples)
+    return {f"acq_{i}": k * (1 + 1e-3 * i) for i in range(num)}
+
+
+def write_pulse_file(path: plib.Path, num_samples: int):
+    t = np.linspace(-4, 4, num_samples)
+    amplitude = np.abs(np.sinc(t))
+    phase = np.where(np.sinc(t) < 0, np.pi, 0.0)
+    with open(path, "w") as f:
+        f.write("PULSENAME: bench\nCOMMENT: synthetic sinc\n\n")
+        np.savetxt(f, np.stack([amplitude, phase], axis=1), fmt="%.8f")
+
+
+def synthetic_params(scale: dict, pulse_file: plib.Path) -> Params:
+    params = Params()
+    entries = synthetic_entries(scale["scans"])
+    params.sampling_k_traj.get_sampling_pattern_buffer().append_columns(**entries)
+    params.sampling_k_traj.register_trajectories(
+        synthetic_trajectories(scale["trajectories"], scale["trajectory_samples"])
+    )
+    for excitation in (True, False):
+        params.pulse.load_from_txt(
+            pulse_file, duration_in_us=scale["pulse_samples"], time_bandwidth=2.5, excitation=excitation
+        )
+    return params
+
+
+def build_cases(scale: dict, work_dir: plib.Path) -> typing.Dict[str, typing.Callable[[], typing.Callable]]:
+    """
+    Each case is a setup callable returning the callable to time, setup is not measured.
+    """
+    pulse_file = work_dir.joinpath("pulse.txt")
+    write_pulse_file(pulse_file, scale["pulse_samples"])
+    params = synthetic_params(scale, pulse_file)
+    json_file = work_dir.joinpath("params.json")
+    bin_file = work_dir.joinpath("params.pypsi")
+    params.save_json(json_file)
+    params.save_binary(bin_file)
+    entries = synthetic_entries(scale["scans"])
+    entry_list = [
+        dict(zip(entries.keys(), values)) for values in zip(*(v.tolist() for v in entries.values()))
+    ]
+
+    def sampling_pattern_entries():
+        def run():
+            p = Params().sampling_k_traj
+            for e in entry_list:
+                p.write_sampling_pattern_entry(**e)
+        return run
+
+    def sampling_pattern_from_list():
+        return lambda: Params().sampling_k_traj.sampling_pattern_from_list(entry_list)
+
+    def register_trajectory():
+        trajectories = synthetic_trajectories(scale["trajectories"], scale["trajectory_samples"])
+
+        def run():
+            p = Params().sampling_k_traj
+            for identifier, trajectory in trajectories.items():
+                p.register_trajectory(trajectory, identifier=identifier)
+        return run
+
+    def load_pulse_from_txt():
+        return lambda: RFPulse.load_from_txt(pulse_file, duration_in_us=scale["pulse_samples"], time_bandwidth=2.5)
+
+    def set_shape_on_raster():
+        pulse = RFPulse.load_from_txt(pulse_file, duration_in_us=scale["pulse_samples"], time_bandwidth=2.5)
+        return lambda: pulse.set_shape_on_raster(RASTER_TIME_S / 2)
+
+    def set_flip_angle():
+        pulse = RFPulse.load_from_txt(pulse_file, duration_in_us=scale["pulse_samples"], time_bandwidth=2.5)
+        angles = iter(np.linspace(0.1, np.pi, 1_000_000))
+        return lambda: pulse.set_flip_angle(next(angles))
+
+    def params_save_json():
+        return lambda: params.save_json(work_dir.joinpath("save.json"))
+
+    def params_load_json():
+        return lambda: load_file(Params, json_file)
+
+    def params_save_binary():
+        return lambda: params.save_binary(work_dir.joinpath("save.pypsi"))
+
+    def params_load_binary():
+        return lambda: Params.load_binary(bin_file)
+
+    def save_as_subclasses():
+        # force, otherwise every repeat after the first finds all sections unchanged and writes nothing
+        return lambda: params.save_as_subclasses(work_dir.joinpath("subclasses"), force=True)
+
+    def from_cli():
+        args = argparse.Namespace(config=Config(config_file=bin_file.as_posix()), extra_files=XConfig())
+        return lambda: Params.from_cli(args)
+
+    return {
+        "write_sampling_pattern_entry": sampling_pattern_entries,
+        "sampling_pattern_from_list": sampling_pattern_from_list,
+        "register_trajectory": register_trajectory,
+        "rf_load_from_txt": load_pulse_from_txt,
+        "rf_set_shape_on_raster": set_shape_on_raster,
+        "rf_set_flip_angle": set_flip_angle,
+        "params_save_json": params_save_json,
+        "params_load_json": params_load_json,
+        "params_save_binary": params_save_binary,
+        "params_load_binary": params_load_binary,
+        "params_save_as_subclasses": save_as_subclasses,
+        "params_from_cli": from_cli,
+    }
+
+
+def measure(setup: typing.Callable[[], typing.Callable], repeats: int) -> dict:
+    times = []
+    for _ in range(repeats):
+        run = setup()
+        gc.collect()
+        t_start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - t_start)
+    # peak memory in a separate run, tracing slows down the timed runs
+    run = setup()
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"median_s": statistics.median(times), "min_s": min(times), "peak_mb": peak / 1024 ** 2}
+
+
+def _git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+        return out.stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> typing.List[str]:
+    """
+    :return: regressions, cases slower or using more memory than the baseline by more than tolerance
+    """
+    regressions = []
+    for case, result in results["results"].items():
+        base = baseline["results"].get(case)
+        if base is None:
+            continue
+        for key in ("median_s", "peak_mb"):
+            if base[key] > 0 and result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{case}: {key} {result[key]:.4g} vs baseline {base[key]:.4g}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_pypsi")
+    parser.add_argument("--scale", choices=list(SCALES.keys()), default="small")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--cases", nargs="*", default=None, help="run only these cases, 'import' for import time")
+    parser.add_argument("--output", type=str, default=None, help="result file, default benchmarks/results/")
+    parser.add_argument("--baseline", type=str, default=None, help="result file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slow down / memory growth")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    scale = SCALES[args.scale]
+    results = {
+        "meta": {
+            "scale": args.scale, "sizes": scale, "repeats": args.repeats, "commit": _git_commit(),
+            "python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S")
+        },
+        "results": {}
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        cases = build_cases(scale, plib.Path(tmp))
+        names = args.cases if args.cases else list(cases.keys()) + ["import"]
+        for name in names:
+            if name == "import":
+                imp = time_import("pypsi", repeats=max(args.repeats, 3))
+                result = {"median_s": imp["median_s"], "min_s": imp["min_s"], "peak_mb": 0.0}
+            elif name in cases:
+                result = measure(cases[name], repeats=args.repeats)
+            else:
+                print(f"unknown case {name}, choose from {list(cases.keys()) + ['import']}")
+                sys.exit(2)
+            results["results"][name] = result
+            print(f"{name:<30} median {result['median_s'] * 1e3:10.2f} ms  min {result['min_s'] * 1e3:10.2f} ms  "
+                  f"peak {result['peak_mb']:9.2f} MB")
+
+    if args.output is None:
+        out_file = ROOT.joinpath("benchmarks", "results", f"{args.scale}_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    else:
+        out_file = plib.Path(args.output).absolute()
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(out_file, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {out_file.as_posix()}")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline["meta"]["scale"] != args.scale:
+            print(f"baseline scale {baseline['meta']['scale']} differs from {args.scale}")
+        regressions = compare(results, baseline, tolerance=args.tolerance)
+        for r in regressions:
+            print(f"regression - {r}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+Batch validation and derivation of many stored config files.
+Configs are loaded (which runs all derivations and checks) and written out via
+save_as_subclasses on a pool of worker processes, one result record per config.
+
+usage: python -m pypsi.batch -i <directory or glob> -o <output path> [-n <num workers>]
+"""
+import dataclasses as dc
+import glob
+import logging
+import multiprocessing
+import os
+import pathlib as plib
+import time
+import typing
+
+import simple_parsing as sp
+
+from .config import Params, load_file
+from .lazy_import import lazy_import
+
+pd = lazy_import("pandas")
+
+log_module = logging.getLogger(__name__)
+
+
+@dc.dataclass
+class BatchConfig(sp.helpers.Serializable):
+    inputs: str = sp.field(default="", alias=["-i"], help="directory or glob pattern of config files")
+    pattern: str = sp.field(default="*.json", alias=["-p"], help="file pattern used if inputs is a directory")
+    output_path: str = sp.field(default="./batch/", alias=["-o"])
+    num_workers: int = sp.field(default=0, alias=["-n"], help="number of worker processes, 0: number of cpus")
+    max_tasks_per_child: int = sp.field(
+        default=50, alias=["-mtc"], help="configs processed per worker before it is replaced, bounds memory"
+    )
+
+
+def collect_config_files(inputs: str, pattern: str = "*.json") -> typing.List[plib.Path]:
+    path = plib.Path(inputs)
+    if path.is_dir():
+        files = sorted(path.glob(pattern))
+    else:
+        files = sorted(plib.Path(f) for f in glob.glob(inputs, recursive=True))
+    return [f.absolute() for f in files if f.is_file()]
+
+
+def _output_dirs(config_files: typing.List[plib.Path], output_path: plib.Path) -> typing.List[plib.Path]:
+    # one sub directory per config named by file stem, made unique for equal stems
+    counts: typing.Dict[str, int] = {}
+    dirs = []
+    for f in config_files:
+        n = counts.get(f.stem, 0)
+        counts[f.stem] = n + 1
+        dirs.append(output_path.joinpath(f.stem if n == 0 else f"{f.stem}_{n}"))
+    return dirs
+
+
+def process_config(task: typing.Tuple[plib.Path, plib.Path]) -> dict:
+    """
+    Load, derive and write the sub-files of one config.
+    :return: result record, failures are caught and reported in the record
+    """
+    config_file, output_dir = task
+    record = {
+        "config_file": config_file.as_posix(), "output_dir": output_dir.as_posix(), "status": "ok", "error": "",
+        "load_s": float("nan"), "save_s": float("nan"), "total_s": float("nan"), "pid": os.getpid()
+    }
+    t_start = time.perf_counter()
+    try:
+        params = load_file(Params, config_file)
+        t_load = time.perf_counter()
+        record["load_s"] = t_load - t_start
+        params.save_as_subclasses(output_dir)
+        record["save_s"] = time.perf_counter() - t_load
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["total_s"] = time.perf_counter() - t_start
+    return record
+
+
+def run_batch(config_files: typing.List[typing.Union[str, plib.Path]], output_path: typing.Union[str, plib.Path],
+              num_workers: int = 0, max_tasks_per_child: int = 50) -> "pd.DataFrame":
+    """
+    Validate and re-derive many configs on a process pool.
+    :param config_files: config files to process
+    :param output_path: sub-files of each config are written to <output_path>/<config stem>/
+    :param num_workers: number of worker processes, 0 uses the number of cpus
+    :param max_tasks_per_child: configs per worker process before it is replaced
+    :return: summary table with one row per config, status, error message and timings
+    """
+    output_path = plib.Path(output_path).absolute()
+    output_path.mkdir(parents=True, exist_ok=True)
+    config_files = [plib.Path(f).absolute() for f in config_files]
+    tasks = list(zip(config_files, _output_dirs(config_files, output_path)))
+    if num_workers < 1:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(min(num_workers, len(tasks)), 1)
+    log_module.info(f"processing {len(tasks)} configs on {num_workers} workers")
+    t_start = time.perf_counter()
+    records = []
+    with multiprocessing.Pool(processes=num_workers, maxtasksperchild=max_tasks_per_child) as pool:
+        for record in pool.imap_unordered(process_config, tasks, chunksize=1):
+            if record["status"] != "ok":
+                log_module.warning(f"failed: {record['config_file']} - {record['error']}")
+            records.append(record)
+    summary = pd.DataFrame(
+        records, columns=["config_file", "output_dir", "status", "error", "load_s", "save_s", "total_s", "pid"]
+    ).sort_values("config_file").reset_index(drop=True)
+    num_failed = int((summary["status"] != "ok").sum())
+    log_module.info(
+        f"processed {summary.shape[0]} configs in {time.perf_counter() - t_start:.2f} s, {num_failed} failed"
+    )
+    return summary
+
+
+def main():
+    parser = sp.ArgumentParser(prog="pypsi_batch")
+    parser.add_arguments(BatchConfig, dest="batch")
+    args = parser.parse_args()
+    config: BatchConfig = args.batch
+
+    config_files = collect_config_files(config.inputs, pattern=config.pattern)
+    if not config_files:
+        err = f"no config files found for input: {config.inputs}"
+        log_module.error(err)
+        raise FileNotFoundError(err)
+    summary = run_batch(
+        config_files, output_path=config.output_path,
+        num_workers=config.num_workers, max_tasks_per_child=config.max_tasks_per_child
+    )
+    s_file = plib.Path(config.output_path).absolute().joinpath("batch_summary.csv")
+    log_module.info(f"write file: {s_file.as_posix()}")
+    summary.to_csv(s_file, index=False)
+    failed = summary[summary["status"] != "ok"]
+    if failed.shape[0] > 0:
+        log_module.info(f"failures:\n{failed[['config_file', 'error']].to_string(index=False)}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,147 @@
+"""
+Content-addressed on-disk cache of fully derived Params.
+The key is a sha256 over the cli configuration, the contents of the config and all extra files
+and the pypsi source itself, hence any change of inputs or derivation code gives a new entry.
+Entries are binary containers, a hit is memory-mapped instead of derived again.
+The cache is bounded in size, least recently used entries are evicted first.
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+import pathlib as plib
+import typing
+
+from .parameters import binary
+
+log_module = logging.getLogger(__name__)
+
+CACHE_VERSION: int = 1
+
+
+@functools.lru_cache(maxsize=1)
+def _source_digest() -> str:
+    # derivations live in the package source, changing them invalidates all entries
+    digest = hashlib.sha256()
+    root = plib.Path(__file__).absolute().parent
+    for f in sorted(root.rglob("*.py")):
+        digest.update(f.relative_to(root).as_posix().encode("utf-8"))
+        digest.update(f.read_bytes())
+    return digest.hexdigest()
+
+
+def _file_digest(path: plib.Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(functools.partial(f.read, 1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ParamsCache:
+    def __init__(self, cache_dir: typing.Union[str, plib.Path], max_size_mb: float = 1024.0):
+        """
+        :param cache_dir: directory of the cache entries, created if missing
+        :param max_size_mb: total size of all entries, least recently used entries are evicted above
+        """
+        self.cache_dir: plib.Path = plib.Path(cache_dir).absolute()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size_mb: float = max_size_mb
+
+    def key(self, config: dict, files: typing.Iterable[typing.Union[str, plib.Path, None]] = ()) -> str:
+        """
+        Stable key of the inputs.
+        :param config: json serializable input configuration, eg. the cli arguments
+        :param files: referenced input files, their contents enter the key, missing files are keyed by name
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps(
+            {"cache_version": CACHE_VERSION, "binary_version": binary.VERSION, "config": config},
+            sort_keys=True, default=str
+        ).encode("utf-8"))
+        digest.update(_source_digest().encode("utf-8"))
+        for f in files:
+            if f is None:
+                digest.update(b"none")
+                continue
+            path = plib.Path(f)
+            if path.is_file():
+                digest.update(_file_digest(path).encode("utf-8"))
+            else:
+                digest.update(f"missing:{path.as_posix()}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def key_from_args(self, args) -> str:
+        """
+        Key of parsed cli arguments (config and extra_files groups).
+        """
+        config = {"config": args.config.to_dict(), "extra_files": args.extra_files.to_dict()}
+        # where the cache lives does not change the result
+        config["config"].pop("cache_dir", None)
+        files = [args.config.config_file] + [f for f in args.extra_files.to_dict().values()]
+        return self.key(config, files=[f if f else None for f in files])
+
+    def _entry(self, key: str) -> plib.Path:
+        return self.cache_dir.joinpath(key).with_suffix(binary.BINARY_SUFFIX)
+
+    def get(self, key: str) -> typing.Optional[plib.Path]:
+        """
+        Path of the entry if cached, marks it as recently used.
+        """
+        entry = self._entry(key)
+        if not entry.is_file():
+            return None
+        try:
+            os.utime(entry)
+        except OSError:
+            # evicted by another process meanwhile
+            return None
+        log_module.debug(f"params cache hit: {key[:16]}")
+        return entry
+
+    def put(self, key: str, params) -> plib.Path:
+        """
+        Store derived params and evict old entries if the cache got too large.
+        """
+        entry = self._entry(key)
+        tmp = entry.with_name(f"{entry.stem}.{os.getpid()}.tmp")
+        binary.save(params, tmp)
+        os.replace(tmp, entry)
+        log_module.debug(f"params cache store: {key[:16]}")
+        self.evict(keep=entry)
+        return entry
+
+    def entries(self) -> typing.List[plib.Path]:
+        return sorted(self.cache_dir.glob(f"*{binary.BINARY_SUFFIX}"))
+
+    def size_mb(self) -> float:
+        return sum(e.stat().st_size for e in self.entries()) / 1024 ** 2
+
+    def evict(self, keep: plib.Path = None):
+        """
+        Remove least recently used entries until the cache fits its size.
+        """
+        stats = []
+        for entry in self.entries():
+            try:
+                stats.append((entry.stat().st_mtime, entry.stat().st_size, entry))
+            except FileNotFoundError:
+                continue
+        total = sum(s[1] for s in stats)
+        limit = self.max_size_mb * 1024 ** 2
+        for _, size, entry in sorted(stats, key=lambda s: s[0]):
+            if total <= limit:
+                break
+            if entry == keep:
+                continue
+            log_module.debug(f"params cache evict: {entry.name}")
+            try:
+                entry.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for entry in self.entries():
+            entry.unlink(missing_ok=True)
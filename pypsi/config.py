@@ -8,15 +8,26 @@ We want a class structure that provides all of the necessary information for:
 - saving and loading sampling patterns
 - interfacing pulse files - store and plot pulses used or feed in pulse shapes
 """
+import concurrent.futures
+import functools
+import json
 import logging
+import os
 import pathlib as plib
+import threading
 import typing
 import numpy as np
-import pandas as pd
 import simple_parsing as sp
 import simple_parsing.helpers.serialization as sphs
 import dataclasses as dc
 from . import parameters
+from .cache import ParamsCache
+from .instrumentation import instrument, stage
+from .lazy_import import lazy_import, on_import
+from .parameters import binary
+from . import shared
+
+pd = lazy_import("pandas")
 
 log_module = logging.getLogger(__name__)
 
@@ -26,6 +37,7 @@ class Config(sp.helpers.Serializable):
     config_file: str = sp.field(default="", alias=["-c"])
     output_path: str = sp.field(default="./test/", alias=["-o"])
     visualize: bool = sp.field(default=True, alias=["-v"])
+    cache_dir: str = sp.field(default="", alias=["-cd"], help="cache derived params there, reused for equal inputs")
 
 
 @dc.dataclass
@@ -39,26 +51,103 @@ class XConfig(sp.helpers.Serializable):
     scanner_specs_file: str = sp.field(default=None, alias="-ssf")
 
 
-@dc.dataclass
-class Params(sp.helpers.Serializable):
-    config: Config = Config()
-    emc: parameters.EmcParameters = parameters.EmcParameters()
-    pypulseq: parameters.PypulseqParameters = parameters.PypulseqParameters()
-    pulse: parameters.RFParameters = parameters.RFParameters()
-    sampling_k_traj: parameters.SamplingKTrajectoryParameters = parameters.SamplingKTrajectoryParameters()
-    recon: parameters.ReconParameters = parameters.ReconParameters()
-    specs: parameters.ScannerParameters = parameters.ScannerParameters()
-
-    def __post_init__(self):
-        self._d_to_set: dict = {
-            "pypulseq_config_file": "pypulseq",
-            "pulse_file": "pulse",
-            "sampling_k_traj_file": "sampling_k_traj",
-            "emc_info_file": "emc",
-            "raw_data_details_file": "recon",
-            "scanner_specs_file": "specs",
+class DeferredSection:
+    """
+    Handle to a Params section that is only decoded when first accessed.
+    """
+    def __init__(self, loader: typing.Callable, source: str = "default"):
+        self.loader = loader
+        self.source = source
+
+    def load(self):
+        log_module.debug(f"decoding deferred section from {self.source}")
+        return self.loader()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(source={self.source})"
+
+
+class SectionField:
+    """
+    Data descriptor for the Params sections, resolves a DeferredSection on first read.
+    """
+    def __init__(self, section_cls):
+        self.section_cls = section_cls
+        self.name: str = ""
+        self.attr_name: str = ""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.attr_name = f"_{name}_section"
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            # dataclass queries the default value on the class, default is a deferred default instance
+            return None
+        value = obj.__dict__.get(self.attr_name)
+        if value is None:
+            value = DeferredSection(self.section_cls)
+        if isinstance(value, DeferredSection):
+            with stage(f"Params.load.{self.name}"):
+                value = value.load()
+            obj.__dict__[self.attr_name] = value
+        return value
+
+    def __set__(self, obj, value):
+        if value is None:
+            value = DeferredSection(self.section_cls)
+        obj.__dict__[self.attr_name] = value
+
+    def is_loaded(self, obj) -> bool:
+        return not isinstance(obj.__dict__.get(self.attr_name), (DeferredSection, type(None)))
+
+    @staticmethod
+    def names(cls) -> typing.Set[str]:
+        return {
+            name for klass in cls.__mro__ for name, attr in klass.__dict__.items() if isinstance(attr, SectionField)
         }
 
+    @staticmethod
+    def of(cls, name: str) -> "SectionField":
+        # class attribute access goes through __get__, hence look up the descriptor in the class dicts,
+        # walking the mro finds the sections of Params subclasses too
+        for klass in cls.__mro__:
+            attr = klass.__dict__.get(name)
+            if isinstance(attr, SectionField):
+                return attr
+        err = f"{cls.__name__} has no section {name}"
+        log_module.error(err)
+        raise AttributeError(err)
+
+
+@dc.dataclass
+class Params(sp.helpers.Serializable, binary.BinarySerializable):
+    # sections are decoded on first access if set as DeferredSection
+    config: Config = SectionField(Config)
+    emc: parameters.EmcParameters = SectionField(parameters.EmcParameters)
+    pypulseq: parameters.PypulseqParameters = SectionField(parameters.PypulseqParameters)
+    pulse: parameters.RFParameters = SectionField(parameters.RFParameters)
+    sampling_k_traj: parameters.SamplingKTrajectoryParameters = SectionField(
+        parameters.SamplingKTrajectoryParameters
+    )
+    recon: parameters.ReconParameters = SectionField(parameters.ReconParameters)
+    specs: parameters.ScannerParameters = SectionField(parameters.ScannerParameters)
+
+    manifest_name: typing.ClassVar[str] = "pypsi_manifest.json"
+    complete_marker_name: typing.ClassVar[str] = "pypsi_save.complete"
+    visualize_figures: typing.ClassVar[typing.Tuple[str, ...]] = (
+        "sampling_pattern", "k_space_trajectories", "pulse_excitation", "pulse_refocusing"
+    )
+    # extra file argument -> section, class level as instances restored from binary containers skip __init__
+    _d_to_set: typing.ClassVar[typing.Dict[str, str]] = {
+        "pypulseq_config_file": "pypulseq",
+        "pulse_file": "pulse",
+        "sampling_k_traj_file": "sampling_k_traj",
+        "emc_info_file": "emc",
+        "raw_data_details_file": "recon",
+        "scanner_specs_file": "specs",
+    }
+
     def display_sequence_configuration(self):
         # build dataframe for visualization of most important data
         names = [
@@ -110,45 +199,271 @@ class Params(sp.helpers.Serializable):
         # display via logging
         log_module.info(df)
 
-    def save_as_subclasses(self, path: typing.Union[str, plib.Path]):
+    @instrument()
+    def save_as_subclasses(self, path: typing.Union[str, plib.Path], force: bool = False,
+                           max_workers: int = None) -> typing.List[str]:
+        """
+        Write each section to its own file. A manifest records the content hash of every section file,
+        sections whose hash did not change since the last save into path are not written again.
+        Sections are written concurrently, each to a temporary file renamed into place once complete.
+        The completion marker is removed first and written after all sections and the manifest.
+        :param path: output directory
+        :param force: write all sections
+        :param max_workers: number of writer threads, default one per section to write
+        :return: names of the sections written
+        """
         # ensure path
         path = plib.Path(path).absolute()
         # check if exists or make
         if path.suffixes:
             path = path.parent
         path.mkdir(parents=True, exist_ok=True)
-        # save
+        manifest = {} if force else self.read_manifest(path)
+        marker = path.joinpath(self.complete_marker_name)
+        marker.unlink(missing_ok=True)
+        sections = {}
+        to_write = []
+        # save, array heavy sections go to binary containers
         for f_name, att_name in self._d_to_set.items():
             suffix = ".json"
             if att_name == "pulse" or att_name == "sampling_k_traj":
-                suffix = ".pkl"
+                suffix = binary.BINARY_SUFFIX
             save_file = path.joinpath(f_name).with_suffix(suffix)
-            log_module.info(f"write file: {save_file.as_posix()}")
             subclass = self.__getattribute__(att_name)
-            if suffix == ".pkl":
-                subclass.save(save_file)
-            else:
-                subclass.save_json(save_file, indent=2)
+            digest = binary.digest(subclass)
+            sections[att_name] = {"file": save_file.name, "digest": digest}
+            previous = manifest.get(att_name, {})
+            if previous.get("digest") == digest and previous.get("file") == save_file.name and save_file.is_file():
+                log_module.debug(f"unchanged, skip file: {save_file.as_posix()}")
+                continue
+            to_write.append((att_name, subclass, save_file))
+        errors = []
+        if to_write:
+            num_workers = len(to_write) if max_workers is None else max(min(max_workers, len(to_write)), 1)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = {
+                    executor.submit(_write_section, att_name, subclass, save_file): att_name
+                    for att_name, subclass, save_file in to_write
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        log_module.error(f"writing section {futures[future]} failed: {e}")
+                        errors.append(e)
+        if errors:
+            # no manifest and no marker, the set is incomplete
+            raise errors[0]
+        _write_atomic(
+            path.joinpath(self.manifest_name),
+            lambda tmp: tmp.write_text(json.dumps({"version": 1, "sections": sections}, indent=2))
+        )
+        _write_atomic(marker, lambda tmp: tmp.write_text(json.dumps({"sections": list(sections.keys())})))
+        return [att_name for att_name, _, _ in to_write]
+
+    @classmethod
+    def read_manifest(cls, path: typing.Union[str, plib.Path]) -> typing.Dict[str, dict]:
+        """
+        Read the section manifest written by save_as_subclasses, compare digests to skip reloading sections.
+        :return: file name and content digest per section, empty if there is no manifest
+        """
+        m_file = plib.Path(path).absolute().joinpath(cls.manifest_name)
+        if not m_file.is_file():
+            return {}
+        with open(m_file, "r") as f:
+            return json.load(f).get("sections", {})
+
+    @classmethod
+    @instrument()
+    def from_cli(cls, args: sp.ArgumentParser.parse_args, lazy: bool = False, cache: ParamsCache = None):
+        """
+        Build from cli arguments.
+        :param args: parsed cli arguments
+        :param lazy: defer decoding of all sections until first access, see prefetch
+        :param cache: reuse derived params for equal inputs, defaults to a cache in config.cache_dir if set
+        """
+        if cache is None and args.config.cache_dir:
+            cache = ParamsCache(args.config.cache_dir)
+        if cache is not None:
+            key = cache.key_from_args(args)
+            entry = cache.get(key)
+            if entry is not None:
+                log_module.info(f"loading cached params: {entry.as_posix()}")
+                try:
+                    return cls.load_lazy(entry) if lazy else cls.load_binary(entry)
+                except FileNotFoundError:
+                    # evicted by another process after the lookup
+                    log_module.info(f"cached params evicted, deriving: {entry.as_posix()}")
+            instance = cls._from_cli(args)
+            cache.put(key, instance)
+            return instance
+        return cls._from_cli(args, lazy=lazy)
 
     @classmethod
-    def from_cli(cls, args: sp.ArgumentParser.parse_args):
+    def _from_cli(cls, args: sp.ArgumentParser.parse_args, lazy: bool = False):
         # create instance, fill config arguments
         instance = cls(config=args.config)
         # check if config file exists and laod
         c_file = plib.Path(args.config.config_file).absolute()
         if c_file.is_file():
             log_module.info(f"loading config file: {c_file.as_posix()}")
-            instance = cls.load(c_file)
+            if lazy:
+                instance = cls.load_lazy(c_file)
+            else:
+                instance = load_file(cls, c_file)
         # check for extra file input
-        instance._load_extra_argfile(extra_files=args.extra_files)
+        instance._load_extra_argfile(extra_files=args.extra_files, lazy=lazy)
         return instance
 
-    def visualize(self):
-        self.sampling_k_traj.plot_sampling_pattern(output_path=self.config.output_path)
-        self.sampling_k_traj.plot_k_space_trajectories(output_path=self.config.output_path)
-        self.pulse.plot(output_path=self.config.output_path)
+    @classmethod
+    @instrument()
+    def load_lazy(cls, path: typing.Union[str, plib.Path]):
+        """
+        Load from file, but only decode the sections when they are first accessed.
+        Binary containers are memory-mapped, other formats are read to a dict without decoding.
+        """
+        path = plib.Path(path)
+        if path.suffix == binary.BINARY_SUFFIX:
+            loaders = binary.load_deferred(cls, path)
+        else:
+            d = sphs.serializable.read_file(path)
+            loaders = {
+                f.name: functools.partial(f.type.from_dict, d[f.name]) if dc.is_dataclass(f.type) else
+                functools.partial(sphs.decode_field, f, d[f.name], containing_dataclass=cls)
+                for f in dc.fields(cls) if f.name in d
+            }
+        source = path.as_posix()
+        # members added by subclasses which are no sections are decoded right away
+        sections = SectionField.names(cls)
+        return cls(**{
+            name: DeferredSection(loader, source=source) if name in sections else loader()
+            for name, loader in loaders.items()
+        })
+
+    def publish_shared(self) -> shared.SharedArrays:
+        """
+        Publish into shared memory once, worker processes attach via attach_shared(handle) instead of
+        receiving pickled copies. Close the returned owner when all workers are done, an owner that is never
+        closed removes the block once it is garbage collected or at interpreter exit, hence keep a reference
+        while workers still need to attach.
+        """
+        return shared.publish(self, prefix="pypsi_params")
 
-    def _load_extra_argfile(self, extra_files: XConfig):
+    @classmethod
+    def attach_shared(cls, handle: shared.SharedHandle, lazy: bool = False):
+        """
+        Attach to published params, pulse waveforms and sampling / trajectory storages are read only views
+        into the shared block.
+        :param handle: handle of the published params, ie. publish_shared().handle
+        :param lazy: defer decoding of the sections until first access
+        """
+        if lazy:
+            return cls.load_lazy(handle.path)
+        return shared.attach(cls, handle)
+
+    def prefetch(self, *sections: str):
+        """
+        Decode deferred sections now.
+        :param sections: names of the sections to decode, all if none given
+        """
+        if not sections:
+            sections = tuple(f.name for f in dc.fields(self))
+        for section in sections:
+            self.__getattribute__(section)
+
+    def is_loaded(self, section: str) -> bool:
+        return SectionField.of(type(self), section).is_loaded(self)
+
+    def get_sampling_masks(self) -> typing.Tuple[parameters.recon_params.SamplingMask,
+                                                 parameters.recon_params.SamplingMask]:
+        """
+        Bit-packed masks of acquired image and navigator lines, stored with the recon section.
+        See ReconParameters.build_sampling_masks.
+        """
+        return self.recon.build_sampling_masks(self.sampling_k_traj)
+
+    def get_k_space_coordinates(self, include_slice: bool = False, rows: np.ndarray = None,
+                                cache_dir: typing.Union[str, plib.Path] = None, **kwargs) -> np.ndarray:
+        """
+        k-space coordinates of the sampling pattern for gridding, k-space steps and centers taken from the
+        pypulseq section: the center phase encode is resolution_n_phase // 2, the center slice encode
+        resolution_slice_num // 2.
+        :param include_slice: add slice encode coordinates (3D encoding), step from the slab extend
+        :param rows: sampling pattern rows to export, default all
+        :param cache_dir: store and memory-map the result there
+        :param kwargs: passed on to SamplingKTrajectoryParameters.get_k_space_coordinates,
+            eg. pe_center / slice_center to override the centers
+        """
+        delta_k_slice = 1e3 / self.pypulseq.z_extend if include_slice else None
+        kwargs.setdefault("pe_center", self.pypulseq.resolution_n_phase // 2)
+        kwargs.setdefault("slice_center", self.pypulseq.resolution_slice_num // 2)
+        return self.sampling_k_traj.get_k_space_coordinates(
+            delta_k_phase=self.pypulseq.delta_k_phase, delta_k_slice=delta_k_slice, rows=rows,
+            cache_dir=cache_dir, **kwargs
+        )
+
+    @instrument()
+    def visualize(self, figures: typing.Iterable[str] = None, max_workers: int = 1):
+        """
+        Render and write the plots, by default sequentially in this process.
+        Only the sections of the requested figures are loaded. With max_workers > 1 independent figures are
+        rendered in parallel on a process pool: workers get the pulse waveforms or attach to the sampling /
+        trajectory section published once into shared memory, nothing else is pickled. Scripts using the pool
+        need an if __name__ == "__main__" guard (spawn / forkserver start methods re-import them).
+        :param figures: names of the figures to produce, see visualize_figures, all if not given
+        :param max_workers: number of worker processes, None for one per figure (at most the number of cpus)
+        """
+        if figures is None:
+            figures = self.visualize_figures
+        figures = list(figures)
+        unknown = [f for f in figures if f not in self.visualize_figures]
+        if unknown:
+            err = f"unknown figures {unknown}, choose from {list(self.visualize_figures)}"
+            log_module.error(err)
+            raise ValueError(err)
+        output_path = self.config.output_path
+        if max_workers is None:
+            max_workers = min(len(figures), os.cpu_count() or 1)
+        if max_workers <= 1 or len(figures) <= 1:
+            for f in figures:
+                if f in _SAMPLING_PLOTS:
+                    self.sampling_k_traj.__getattribute__(_SAMPLING_PLOTS[f])(output_path=output_path)
+                else:
+                    self.pulse.plot(output_path=output_path, excitation=f == "pulse_excitation")
+            return
+        sampling_block = None
+        if any(f in _SAMPLING_PLOTS for f in figures):
+            sampling_block = shared.publish(self.sampling_k_traj, prefix="pypsi_visualize")
+        errors = {}
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {}
+                for f in figures:
+                    if f in _SAMPLING_PLOTS:
+                        future = executor.submit(
+                            _plot_sampling_k_traj, sampling_block.handle, _SAMPLING_PLOTS[f], output_path
+                        )
+                    else:
+                        excitation = f == "pulse_excitation"
+                        future = executor.submit(
+                            _plot_pulse, self.pulse.excitation if excitation else self.pulse.refocusing, output_path,
+                            "exc" if excitation else "ref"
+                        )
+                    futures[future] = f
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        errors[futures[future]] = e
+                        log_module.error(f"plotting {futures[future]} failed: {e}")
+        finally:
+            if sampling_block is not None:
+                sampling_block.close()
+        if errors:
+            raise next(iter(errors.values()))
+
+    @instrument()
+    def _load_extra_argfile(self, extra_files: XConfig, lazy: bool = False):
         # check through all arguments
         for mem, f_name in extra_files.__dict__.items():
             # check if provided
@@ -158,18 +473,76 @@ class Params(sp.helpers.Serializable):
                 path = plib.Path(f_name)
                 if path.is_file():
                     log_module.info(f"load file: {path.as_posix()}")
+                    if path.parent.joinpath(self.manifest_name).is_file() and \
+                            not path.parent.joinpath(self.complete_marker_name).is_file():
+                        log_module.warning(
+                            f"{path.parent.as_posix()} has no completion marker, "
+                            f"the section files might stem from an interrupted save"
+                        )
                     # get corresponding member
                     mem_name = self._d_to_set.get(mem)
                     if mem_name is not None:
-                        mem = extra_files.__getattribute__(mem_name)
-                        mem.load(path)
-                        self.__setattr__(mem_name, mem)
+                        section_cls = SectionField.of(type(self), mem_name).section_cls
+                        if lazy:
+                            section = DeferredSection(
+                                functools.partial(load_file, section_cls, path), source=path.as_posix()
+                            )
+                        else:
+                            section = load_file(section_cls, path)
+                        self.__setattr__(mem_name, section)
                 elif not path.is_file():
                     err = f"{path} is not a file. exiting..."
                     log_module.error(err)
                     raise FileNotFoundError(err)
 
 
+def _write_atomic(path: plib.Path, write: typing.Callable[[plib.Path], None]):
+    # write to a temporary file in the same directory and rename it, readers never see partial files
+    tmp_file = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        write(tmp_file)
+        os.replace(tmp_file, path)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+
+def _write_section(att_name: str, subclass, save_file: plib.Path):
+    log_module.info(f"write file: {save_file.as_posix()}")
+    with stage(f"Params.save.{att_name}"):
+        if save_file.suffix == binary.BINARY_SUFFIX:
+            _write_atomic(save_file, functools.partial(binary.save, subclass))
+        else:
+            _write_atomic(save_file, functools.partial(subclass.save_json, indent=2))
+
+
+_SAMPLING_PLOTS = {
+    "sampling_pattern": "plot_sampling_pattern", "k_space_trajectories": "plot_k_space_trajectories"
+}
+
+
+def _plot_sampling_k_traj(handle: shared.SharedHandle, plot: str, output_path: str):
+    # runs in a worker process, the section is attached from shared memory instead of unpickled
+    section = shared.attach(parameters.SamplingKTrajectoryParameters, handle)
+    section.__getattribute__(plot)(output_path=output_path)
+
+
+def _plot_pulse(pulse: parameters.rf_params.RFPulse, output_path: str, name: str):
+    pulse.plot(output_path=output_path, name=name)
+
+
+def load_file(cls, path: typing.Union[str, plib.Path]):
+    """
+    Load an instance of the (sub-)class from file, binary containers are memory-mapped.
+    """
+    path = plib.Path(path)
+    with stage(f"load_file.{cls.__name__}"):
+        if path.suffix == binary.BINARY_SUFFIX:
+            return binary.load(cls, path)
+        if path.suffix == ".pkl":
+            log_module.warning(f"loading pickled file {path.as_posix()}, only load pickle files from trusted sources")
+        return cls.load(path)
+
+
 # set serializable encoders
 @sphs.encode.register
 def encode_ndarray(obj: np.ndarray):
@@ -177,15 +550,21 @@ def encode_ndarray(obj: np.ndarray):
     return obj.tolist()
 
 
-@sphs.encode.register
-def encode_pandas_dataframe(obj: pd.DataFrame):
+def encode_pandas_dataframe(obj: "pd.DataFrame"):
     """ encode pandas dataframe as dict """
     return obj.to_dict()
 
 
+def _register_pandas_codecs(pandas):
+    # pandas is imported lazily, register its codecs once it is in use
+    sphs.encode.register(pandas.DataFrame, encode_pandas_dataframe)
+    sphs.register_decoding_fn(pandas.DataFrame, pandas.DataFrame.from_dict)
+
+
+on_import("pandas", _register_pandas_codecs)
+
 # set serializable decoders
 sphs.register_decoding_fn(np.ndarray, np.array)
-sphs.register_decoding_fn(pd.DataFrame, pd.DataFrame.from_dict)
 
 
 def create_cli() -> (sp.ArgumentParser, sp.ArgumentParser.parse_args):
@@ -200,11 +579,11 @@ if __name__ == '__main__':
     parser, args = create_cli()
 
     params = Params.from_cli(args=args)
-    s_file = plib.Path("./default_config/pypsi.pkl").absolute()
+    s_file = plib.Path("./default_config/pypsi").with_suffix(binary.BINARY_SUFFIX).absolute()
     s_file.parent.mkdir(parents=True, exist_ok=True)
-    params.save(s_file.as_posix())
+    params.save_binary(s_file.as_posix())
 
     params.save_as_subclasses(s_file.parent.as_posix())
 
-    params = Params.load(s_file.as_posix())
+    params = Params.load_binary(s_file.as_posix())
     log_module.info("success")
@@ -0,0 +1,207 @@
+"""
+Planner of EMC dictionary simulations over T2 x B1 (x B0) grids on a process pool.
+The protocol (EmcParameters and its event table) and the pulse waveforms (RFParameters) are published
+once into shared memory, workers receive a small EmcJob descriptor and attach to the shared block.
+Results are written by the workers directly into a preallocated shared output array.
+"""
+import concurrent.futures
+import dataclasses as dc
+import functools
+import logging
+import os
+import typing
+
+import numpy as np
+import simple_parsing as sp
+
+from .parameters import binary, EmcParameters, EmcEventTable, RFParameters
+from .shared import SharedArrays, SharedHandle, remove_on_collect
+
+log_module = logging.getLogger(__name__)
+
+
+@dc.dataclass
+class EmcGrid(sp.helpers.Serializable):
+    # T2 values [ms]
+    t2_ms: typing.List[float] = sp.field(default_factory=lambda: [35.0])
+    # B1 scaling factors
+    b1: typing.List[float] = sp.field(default_factory=lambda: [1.0])
+    # B0 offsets [Hz], a single 0 for simulations without B0 dimension
+    b0_hz: typing.List[float] = sp.field(default_factory=lambda: [0.0])
+
+    axes: typing.ClassVar[typing.Tuple[str, ...]] = ("t2_ms", "b1", "b0_hz")
+
+    @property
+    def shape(self) -> typing.Tuple[int, ...]:
+        return tuple(len(self.__getattribute__(a)) for a in self.axes)
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    def points(self, start: int = 0, stop: int = None) -> typing.Dict[str, np.ndarray]:
+        """
+        Grid values of the flat (C order) point range [start, stop).
+        """
+        flat = np.arange(start, self.size if stop is None else stop)
+        indices = np.unravel_index(flat, self.shape)
+        return {a: np.asarray(self.__getattribute__(a), dtype=np.float64)[i] for a, i in zip(self.axes, indices)}
+
+
+@dc.dataclass(frozen=True)
+class EmcJob:
+    # shared protocol and pulses
+    inputs: SharedHandle
+    # shared output array (.npy)
+    output: str
+    # flat grid point range [start, stop)
+    start: int
+    stop: int
+
+
+@dc.dataclass
+class EmcJobInputs:
+    emc: EmcParameters
+    event_table: EmcEventTable
+    pulse: RFParameters
+    grid: EmcGrid
+
+
+def _strip_prefix(arrays: typing.Dict[str, np.ndarray], prefix: str) -> typing.Dict[str, np.ndarray]:
+    return {k[len(prefix):]: v for k, v in arrays.items() if k.startswith(prefix)}
+
+
+@functools.lru_cache(maxsize=8)
+def attach_inputs(handle: SharedHandle) -> EmcJobInputs:
+    """
+    Attach to the shared inputs of a plan, cached per process: every worker maps the block once.
+    All arrays are read only views into shared memory.
+    """
+    meta, arrays = handle.attach()
+    return EmcJobInputs(
+        emc=EmcParameters.from_dict(meta["emc"]),
+        event_table=binary.unpack(
+            EmcEventTable, scalars=meta["event_table"]["fields"], storages={},
+            arrays=_strip_prefix(arrays, "event_table/")
+        ),
+        pulse=binary.unpack(
+            RFParameters, scalars=meta["pulse"]["fields"], storages={},
+            arrays=_strip_prefix(arrays, "pulse/")
+        ),
+        grid=EmcGrid.from_dict(meta["grid"])
+    )
+
+
+def run_job(simulate: typing.Callable[[EmcJobInputs, typing.Dict[str, np.ndarray]], np.ndarray],
+            job: EmcJob) -> int:
+    """
+    Simulate one chunk of grid points and write it into the shared output.
+    :param simulate: called with the attached inputs and the grid values of the chunk,
+        returns the signals of shape (num_points, *point_shape)
+    :return: number of simulated points
+    """
+    inputs = attach_inputs(job.inputs)
+    out = SharedArrays.open_writable(job.output)
+    out[job.start:job.stop] = simulate(inputs, inputs.grid.points(job.start, job.stop))
+    out.flush()
+    return job.stop - job.start
+
+
+class EmcDictionaryPlan:
+    def __init__(self, emc: EmcParameters, pulse: RFParameters, grid: EmcGrid,
+                 point_shape: typing.Tuple[int, ...] = None, dtype=np.float64,
+                 num_chunks: int = None, chunk_size: int = None, num_workers: int = None):
+        """
+        Publish the protocol and allocate the output of a dictionary simulation.
+        :param emc: simulated protocol
+        :param pulse: excitation and refocusing pulses
+        :param grid: simulated parameter grid
+        :param point_shape: shape of the result per grid point, default (etl,) echo signals
+        :param dtype: output dtype, eg. np.complex64 for complex signals
+        :param num_chunks: number of jobs, default 4 per worker so uneven workers balance out
+        :param chunk_size: points per job instead of num_chunks
+        :param num_workers: worker processes, defaults to the number of cpus
+        """
+        self.grid: EmcGrid = grid
+        self.num_workers: int = num_workers
+        self.point_shape: typing.Tuple[int, ...] = tuple(point_shape) if point_shape is not None else (emc.etl,)
+        self.chunks: typing.List[typing.Tuple[int, int]] = self.balanced_chunks(
+            grid.size, num_chunks=num_chunks, chunk_size=chunk_size, num_workers=num_workers
+        )
+
+        t_scalars, _, t_arrays = binary.pack(emc.get_event_table())
+        p_scalars, _, p_arrays = binary.pack(pulse)
+        arrays = {f"event_table/{k}": v for k, v in t_arrays.items()}
+        arrays.update({f"pulse/{k}": v for k, v in p_arrays.items()})
+        meta = {
+            "emc": emc.to_dict(), "grid": grid.to_dict(),
+            "event_table": {"fields": t_scalars}, "pulse": {"fields": p_scalars}
+        }
+        self._inputs = SharedArrays(arrays, meta=meta, prefix="pypsi_emc_inputs")
+        self._output_path, self.output = SharedArrays.allocate(
+            (grid.size, *self.point_shape), dtype=dtype, prefix="pypsi_emc_output"
+        )
+        self._remove_output = remove_on_collect(self, self._output_path)
+        log_module.info(
+            f"emc dictionary plan: {grid.size} points {grid.shape} in {len(self.chunks)} jobs, "
+            f"shared inputs {self._inputs.nbytes / 1024 ** 2:.2f} MB"
+        )
+
+    @staticmethod
+    def balanced_chunks(num_points: int, num_chunks: int = None, chunk_size: int = None,
+                        num_workers: int = None) -> typing.List[typing.Tuple[int, int]]:
+        """
+        Split num_points into contiguous ranges whose sizes differ by at most one.
+        """
+        if chunk_size is not None:
+            num_chunks = -(-num_points // max(chunk_size, 1))
+        elif num_chunks is None:
+            num_chunks = 4 * (num_workers or os.cpu_count() or 1)
+        num_chunks = max(min(num_chunks, num_points), 1)
+        bounds = np.linspace(0, num_points, num_chunks + 1).round().astype(int)
+        return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    @property
+    def jobs(self) -> typing.List[EmcJob]:
+        return [
+            EmcJob(inputs=self._inputs.handle, output=self._output_path.as_posix(), start=start, stop=stop)
+            for start, stop in self.chunks
+        ]
+
+    def attach_inputs(self) -> EmcJobInputs:
+        return attach_inputs(self._inputs.handle)
+
+    def run(self, simulate: typing.Callable[[EmcJobInputs, typing.Dict[str, np.ndarray]], np.ndarray],
+            max_workers: int = None) -> np.ndarray:
+        """
+        Simulate all jobs on a process pool.
+        :param simulate: picklable (module level) function, see run_job
+        :param max_workers: defaults to num_workers of the plan, 1 runs sequentially in this process
+        :return: output of shape (*grid.shape, *point_shape)
+        """
+        max_workers = max_workers if max_workers is not None else self.num_workers
+        jobs = self.jobs
+        if max_workers == 1:
+            for job in jobs:
+                run_job(simulate, job)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+                # the simulate function is pickled once per job, the inputs never
+                for future in concurrent.futures.as_completed(
+                        [executor.submit(run_job, simulate, job) for job in jobs]):
+                    future.result()
+        return self.output.reshape(*self.grid.shape, *self.point_shape)
+
+    def close(self):
+        """
+        Remove the shared blocks, the output stays valid in this process.
+        Blocks of a plan dropped without close are removed once it is garbage collected.
+        """
+        self._inputs.close()
+        self._remove_output()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
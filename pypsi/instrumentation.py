@@ -0,0 +1,158 @@
+"""
+Opt-in stage timing and memory instrumentation of the pypsi pipeline.
+Instrumented stages record call counts, wall time and the net python heap allocation (via tracemalloc).
+Disabled (default) an instrumented call costs one flag check.
+Enable via enable() or by setting the environment variable PYPSI_INSTRUMENT=1.
+"""
+import contextlib
+import functools
+import json
+import logging
+import os
+import pathlib as plib
+import threading
+import time
+import tracemalloc
+import typing
+
+log_module = logging.getLogger(__name__)
+
+
+class _State:
+    def __init__(self):
+        self.enabled: bool = False
+        self.trace_memory: bool = False
+        # tracemalloc was started by enable(), tracing started by the caller is left running
+        self.owns_tracing: bool = False
+        self.records: typing.Dict[str, dict] = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+
+_state = _State()
+
+
+def enable(trace_memory: bool = True):
+    """
+    Start recording instrumented stages.
+    :param trace_memory: record allocation deltas via tracemalloc, slows down allocation heavy code
+    """
+    _state.trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _state.owns_tracing = True
+    _state.enabled = True
+
+
+def disable():
+    _state.enabled = False
+    if _state.owns_tracing and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _state.owns_tracing = False
+    _state.trace_memory = False
+
+
+def is_enabled() -> bool:
+    return _state.enabled
+
+
+def reset():
+    with _state.lock:
+        _state.records = {}
+
+
+def _record(name: str, duration_s: float, alloc_bytes: int, depth: int):
+    with _state.lock:
+        record = _state.records.get(name)
+        if record is None:
+            record = {"calls": 0, "total_s": 0.0, "max_s": 0.0, "alloc_mb": 0.0, "depth": depth}
+            _state.records[name] = record
+        record["calls"] += 1
+        record["total_s"] += duration_s
+        record["max_s"] = max(record["max_s"], duration_s)
+        record["alloc_mb"] += alloc_bytes / 1024 ** 2
+        record["depth"] = min(record["depth"], depth)
+
+
+@contextlib.contextmanager
+def _measure(name: str):
+    depth = getattr(_state.local, "depth", 0)
+    _state.local.depth = depth + 1
+    trace = _state.trace_memory and tracemalloc.is_tracing()
+    mem_start = tracemalloc.get_traced_memory()[0] if trace else 0
+    t_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - t_start
+        alloc = tracemalloc.get_traced_memory()[0] - mem_start if trace else 0
+        _state.local.depth = depth
+        _record(name, duration, alloc, depth)
+
+
+def stage(name: str) -> typing.ContextManager:
+    """
+    Context manager recording a named stage, no op if instrumentation is disabled.
+    """
+    if not _state.enabled:
+        return contextlib.nullcontext()
+    return _measure(name)
+
+
+def instrument(name: str = None):
+    """
+    Decorator recording each call of the function as a stage.
+    :param name: stage name, defaults to the qualified function name
+    """
+    def decorator(func):
+        stage_name = name if name is not None else func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state.enabled:
+                return func(*args, **kwargs)
+            with _measure(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report() -> dict:
+    """
+    Get the recorded stages: calls, total and max wall time, net allocation and nesting depth per stage.
+    """
+    with _state.lock:
+        stages = {name: dict(record) for name, record in _state.records.items()}
+    result = {"stages": stages}
+    if _state.trace_memory and tracemalloc.is_tracing():
+        result["traced_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    return result
+
+
+def write_report(path: typing.Union[str, plib.Path]):
+    path = plib.Path(path).absolute()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    log_module.info(f"write instrumentation report: {path.as_posix()}")
+    with open(path, "w") as f:
+        json.dump(report(), f, indent=2)
+
+
+def log_summary(level: int = logging.INFO):
+    """
+    Log the recorded stages sorted by total time, indented by nesting depth.
+    """
+    stages = report()["stages"]
+    if not stages:
+        log_module.log(level, "no instrumented stages recorded")
+        return
+    lines = [f"{'stage':<50} {'calls':>6} {'total [s]':>10} {'max [s]':>10} {'alloc [MB]':>11}"]
+    for name, r in sorted(stages.items(), key=lambda item: -item[1]["total_s"]):
+        lines.append(
+            f"{'  ' * r['depth'] + name:<50} {r['calls']:>6} {r['total_s']:>10.4f} {r['max_s']:>10.4f} "
+            f"{r['alloc_mb']:>11.2f}"
+        )
+    log_module.log(level, "pypsi stage timings\n" + "\n".join(lines))
+
+
+if os.environ.get("PYPSI_INSTRUMENT", "").lower() in ("1", "true", "yes"):
+    enable()
@@ -0,0 +1,70 @@
+"""
+Deferred imports of heavy optional dependencies (pandas, plotly).
+Modules are only imported on first attribute access of their proxy,
+hooks registered for a module run once right after it got imported.
+"""
+import importlib
+import logging
+import threading
+import types
+import typing
+
+log_module = logging.getLogger(__name__)
+
+_proxies: typing.Dict[str, "LazyModule"] = {}
+_hooks: typing.Dict[str, typing.List[typing.Callable[[types.ModuleType], None]]] = {}
+_lock = threading.RLock()
+
+
+class LazyModule:
+    """
+    Proxy of a module that is imported on first attribute access.
+    """
+    def __init__(self, name: str):
+        self._name = name
+        self._module: typing.Optional[types.ModuleType] = None
+
+    def _load(self) -> types.ModuleType:
+        if self._module is None:
+            with _lock:
+                if self._module is None:
+                    log_module.debug(f"importing {self._name}")
+                    self._module = importlib.import_module(self._name)
+                    for hook in _hooks.pop(self._name, []):
+                        hook(self._module)
+        return self._module
+
+    def __getattr__(self, item: str):
+        return getattr(self._load(), item)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<{self.__class__.__name__} {self._name} ({state})>"
+
+    def is_loaded(self) -> bool:
+        return self._module is not None
+
+
+def lazy_import(name: str) -> LazyModule:
+    """
+    Get the (shared) lazy proxy of a module.
+    :param name: full module name, eg. "plotly.express"
+    """
+    with _lock:
+        proxy = _proxies.get(name)
+        if proxy is None:
+            proxy = LazyModule(name)
+            _proxies[name] = proxy
+        return proxy
+
+
+def on_import(name: str, hook: typing.Callable[[types.ModuleType], None]):
+    """
+    Register a hook running once the module is imported via its proxy, runs directly if that happened already.
+    """
+    with _lock:
+        proxy = lazy_import(name)
+        if proxy.is_loaded():
+            hook(proxy._load())
+        else:
+            _hooks.setdefault(name, []).append(hook)
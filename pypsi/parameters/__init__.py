@@ -1,7 +1,10 @@
 
 from .emc_params import EmcParameters
+from .emc_events import EmcEventTable
 from .pypulseq_params import PypulseqParameters
 from .recon_params import ReconParameters
 from .sampling_k_traj_params import SamplingKTrajectoryParameters
 from .scanner_params import ScannerParameters
 from .rf_params import RFParameters
+from .rf_bank import RFPulseBank
+from . import binary
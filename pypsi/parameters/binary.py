@@ -0,0 +1,307 @@
+"""
+Binary container format for the parameter classes.
+A container is a single file: a small JSON header holding all scalar members
+followed by the raw, aligned data of every numpy array and array backed storage member.
+On load the arrays are memory-mapped instead of parsed, nothing is unpickled.
+
+Layout: magic (8 bytes) | version (uint32) | header length (uint64) | JSON header | padding | array data
+
+Instances are restored in their stored state: the derived attributes set in __post_init__ are stored alongside
+the fields and __post_init__ is not run again on load, deriving from already derived values is not idempotent.
+"""
+import dataclasses as dc
+import functools
+import hashlib
+import json
+import logging
+import pathlib as plib
+import struct
+import typing
+
+import numpy as np
+import simple_parsing.helpers.serialization as sphs
+
+from .storage import StorageField
+
+log_module = logging.getLogger(__name__)
+
+BINARY_SUFFIX: str = ".pypsi"
+MAGIC: bytes = b"PYPSIBIN"
+VERSION: int = 1
+ALIGNMENT: int = 64
+_PREFIX = struct.Struct("<8sIQ")
+# key of the derived (non field) attributes within the packed scalars of an instance
+DERIVED_KEY: str = "__derived__"
+
+
+def _aligned(num: int) -> int:
+    return (num + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _json_default(obj):
+    # numpy scalars sneak into fields via derived values
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def write_container(path: typing.Union[str, plib.Path], meta: dict, arrays: typing.Dict[str, np.ndarray]):
+    """
+    Write a container file.
+    :param path: file path
+    :param meta: JSON serializable header content
+    :param arrays: arrays to store, keyed by name
+    """
+    layout = {}
+    offset = 0
+    data = []
+    for key, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        if arr.dtype.hasobject:
+            err = f"can not store object array {key} in binary container"
+            log_module.error(err)
+            raise TypeError(err)
+        offset = _aligned(offset)
+        layout[key] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        data.append((offset, arr))
+        offset += arr.nbytes
+    header = json.dumps({"meta": meta, "arrays": layout}, default=_json_default).encode("utf-8")
+    data_start = _aligned(_PREFIX.size + len(header))
+    with open(path, "wb") as f:
+        f.write(_PREFIX.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        for arr_offset, arr in data:
+            f.seek(data_start + arr_offset)
+            f.write(arr.data)
+        # make sure the file covers the padding of the header as well
+        f.truncate(data_start + offset)
+
+
+def read_container(path: typing.Union[str, plib.Path], mmap: bool = True) \
+        -> typing.Tuple[dict, typing.Dict[str, np.ndarray]]:
+    """
+    Read a container file.
+    :param path: file path
+    :param mmap: memory-map the arrays read only, otherwise read them into memory
+    :return: header meta and arrays keyed by name
+    """
+    with open(path, "rb") as f:
+        magic, version, header_len = _PREFIX.unpack(f.read(_PREFIX.size))
+        if magic != MAGIC:
+            err = f"{path} is not a pypsi binary container"
+            log_module.error(err)
+            raise ValueError(err)
+        if version > VERSION:
+            err = f"binary container version {version} of {path} not supported (max {VERSION})"
+            log_module.error(err)
+            raise ValueError(err)
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    data_start = _aligned(_PREFIX.size + header_len)
+    buffer = None
+    if mmap and header["arrays"]:
+        buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for key, layout in header["arrays"].items():
+        dtype = np.dtype(layout["dtype"])
+        shape = tuple(layout["shape"])
+        count = int(np.prod(shape, dtype=np.int64))
+        start = data_start + layout["offset"]
+        if count == 0:
+            arrays[key] = np.empty(shape, dtype=dtype)
+        elif buffer is not None:
+            arrays[key] = buffer[start:start + count * dtype.itemsize].view(dtype).reshape(shape)
+        else:
+            arrays[key] = np.fromfile(path, dtype=dtype, count=count, offset=start).reshape(shape)
+    return header["meta"], arrays
+
+
+def _storage_fields(cls) -> typing.Dict[str, StorageField]:
+    fields = {}
+    for klass in reversed(cls.__mro__):
+        for name, attr in klass.__dict__.items():
+            if isinstance(attr, StorageField):
+                fields[name] = attr
+    return fields
+
+
+def pack(obj, prefix: str = "") -> typing.Tuple[dict, dict, typing.Dict[str, np.ndarray]]:
+    """
+    Split a dataclass instance into JSON scalars, storage metadata and arrays.
+    Arrays and storages are keyed by their dotted attribute path.
+    """
+    scalars = {}
+    storages = {}
+    arrays = {}
+    storage_fields = _storage_fields(type(obj))
+    for field in dc.fields(obj):
+        name = field.name
+        path = f"{prefix}{name}"
+        if name in storage_fields:
+            storage = storage_fields[name].get_storage(obj)
+            s_arrays, s_meta = storage.to_arrays()
+            storages[path] = s_meta
+            for key, arr in s_arrays.items():
+                arrays[f"{path}:{key}"] = arr
+            continue
+        value = obj.__getattribute__(name)
+        if dc.is_dataclass(value):
+            s_scalars, s_storages, s_arrays = pack(value, prefix=f"{path}.")
+            scalars[name] = s_scalars
+            storages.update(s_storages)
+            arrays.update(s_arrays)
+        elif isinstance(value, np.ndarray):
+            arrays[path] = value
+        else:
+            scalars[name] = sphs.encode(value)
+    derived = {}
+    field_names = {field.name for field in dc.fields(obj)}
+    for name, value in vars(obj).items():
+        # private attributes are caches or descriptor backed, they are rebuilt on demand
+        if name in field_names or name.startswith("_"):
+            continue
+        if isinstance(value, np.ndarray):
+            arrays[f"{prefix}{name}"] = value
+        else:
+            derived[name] = sphs.encode(value)
+    scalars[DERIVED_KEY] = derived
+    return scalars, storages, arrays
+
+
+def digest(obj) -> str:
+    """
+    Content hash of a dataclass instance, computed from the packed members without encoding a file.
+    """
+    scalars, storages, arrays = pack(obj)
+    h = hashlib.sha256()
+    h.update(json.dumps(
+        {"class": type(obj).__qualname__, "fields": scalars, "storages": storages},
+        sort_keys=True, default=_json_default
+    ).encode("utf-8"))
+    for key in sorted(arrays.keys()):
+        arr = np.ascontiguousarray(arrays[key])
+        h.update(f"{key}:{arr.dtype.str}:{arr.shape}".encode("utf-8"))
+        h.update(arr.data)
+    return h.hexdigest()
+
+
+def _set_path(obj, path: str, value):
+    names = path.split(".")
+    for name in names[:-1]:
+        obj = obj.__getattribute__(name)
+    obj.__setattr__(names[-1], value)
+
+
+def _restore(cls, scalars: dict):
+    # build without __init__, hence without __post_init__: the stored fields and derived attributes already are
+    # the derived state. Containers written before derived attributes were stored are decoded via from_dict
+    if DERIVED_KEY not in scalars:
+        return cls.from_dict(scalars)
+    instance = cls.__new__(cls)
+    for field in dc.fields(cls):
+        name = field.name
+        if name in scalars:
+            raw = scalars[name]
+            if dc.is_dataclass(field.type) and isinstance(raw, dict):
+                value = _restore(field.type, raw)
+            elif isinstance(raw, (bool, int, float, str, type(None))):
+                # stored as is, decoding would cast (eg. an int stored in a float field)
+                value = raw
+            else:
+                value = sphs.decode_field(field, raw, containing_dataclass=cls)
+        elif field.default is not dc.MISSING:
+            value = field.default
+        elif field.default_factory is not dc.MISSING:
+            value = field.default_factory()
+        else:
+            # arrays and storages, set by unpack
+            continue
+        object.__setattr__(instance, name, value)
+    instance.__dict__.update(scalars[DERIVED_KEY])
+    return instance
+
+
+def unpack(cls, scalars: dict, storages: dict, arrays: typing.Dict[str, np.ndarray]):
+    """
+    Build an instance of cls from the output of pack, arrays are used as is (no copies).
+    """
+    instance = _restore(cls, scalars)
+    storage_arrays: typing.Dict[str, dict] = {path: {} for path in storages.keys()}
+    for key, arr in arrays.items():
+        if ":" in key:
+            path, name = key.split(":", 1)
+            storage_arrays[path][name] = arr
+        else:
+            _set_path(instance, key, arr)
+    for path, meta in storages.items():
+        parent = instance
+        names = path.split(".")
+        for name in names[:-1]:
+            parent = parent.__getattribute__(name)
+        storage_cls = _storage_fields(type(parent))[names[-1]].storage_cls
+        parent.__setattr__(names[-1], storage_cls.from_arrays(storage_arrays[path], meta))
+    return instance
+
+
+def save(obj, path: typing.Union[str, plib.Path]):
+    scalars, storages, arrays = pack(obj)
+    meta = {"class": type(obj).__qualname__, "fields": scalars, "storages": storages}
+    write_container(path, meta=meta, arrays=arrays)
+
+
+def load(cls, path: typing.Union[str, plib.Path], mmap: bool = True):
+    meta, arrays = read_container(path, mmap=mmap)
+    if meta.get("class") != cls.__qualname__:
+        err = f"binary container {path} holds {meta.get('class')}, not {cls.__qualname__}"
+        log_module.error(err)
+        raise TypeError(err)
+    return unpack(cls, scalars=meta["fields"], storages=meta["storages"], arrays=arrays)
+
+
+def _strip_prefix(d: dict, prefix: str) -> dict:
+    return {k[len(prefix):]: v for k, v in d.items() if k.startswith(prefix)}
+
+
+def load_deferred(cls, path: typing.Union[str, plib.Path], mmap: bool = True) -> typing.Dict[str, typing.Callable]:
+    """
+    Read the container header and map the arrays, but defer decoding the dataclass members of cls.
+    :return: one loader per member found in the container (except arrays), calling it builds the member
+    """
+    meta, arrays = read_container(path, mmap=mmap)
+    if meta.get("class") != cls.__qualname__:
+        err = f"binary container {path} holds {meta.get('class')}, not {cls.__qualname__}"
+        log_module.error(err)
+        raise TypeError(err)
+    scalars = meta["fields"]
+    loaders = {}
+    for field in dc.fields(cls):
+        name = field.name
+        if name not in scalars:
+            continue
+        if not dc.is_dataclass(field.type):
+            loaders[name] = functools.partial(sphs.decode_field, field, scalars[name], containing_dataclass=cls)
+            continue
+        prefix = f"{name}."
+        loaders[name] = functools.partial(
+            unpack, field.type, scalars=scalars[name],
+            storages=_strip_prefix(meta["storages"], prefix), arrays=_strip_prefix(arrays, prefix)
+        )
+    return loaders
+
+
+class BinarySerializable:
+    """
+    Mixin adding the binary container format to the Serializable parameter classes.
+    """
+    def save_binary(self, path: typing.Union[str, plib.Path]):
+        save(self, path)
+
+    @classmethod
+    def load_binary(cls, path: typing.Union[str, plib.Path], mmap: bool = True):
+        """
+        Load from binary container.
+        :param path: file path
+        :param mmap: memory-map arrays read only, if False arrays are read into memory
+        """
+        return load(cls, path, mmap=mmap)
@@ -0,0 +1,135 @@
+"""
+Array based event table of the EMC multi echo spin echo timeline.
+Every row is one gradient block (pulse, pulse verse lobe, rephaser, crusher, acquisition) with its start,
+duration and gradient amplitude, pulse blocks additionally carry rf index, flip angle and phase.
+Vectorized simulators consume the arrays directly instead of re-deriving the timeline from the scalars.
+"""
+import dataclasses as dc
+import logging
+import typing
+
+import numpy as np
+import simple_parsing as sp
+
+from .binary import BinarySerializable
+
+log_module = logging.getLogger(__name__)
+
+
+@dc.dataclass
+class EmcEventTable(sp.helpers.Serializable, BinarySerializable):
+    # block start and duration [us], excitation starts at 0
+    start_us: np.ndarray = sp.field(default_factory=lambda: np.zeros(0))
+    duration_us: np.ndarray = sp.field(default_factory=lambda: np.zeros(0))
+    # gradient amplitude during the block [mT/m]
+    gradient_mT_m: np.ndarray = sp.field(default_factory=lambda: np.zeros(0))
+    # event type, index into event_types
+    event_type: np.ndarray = sp.field(default_factory=lambda: np.zeros(0, dtype=np.int8))
+    # rf pulse played during the block, 0 excitation, 1 refocusing, -1 none
+    rf_index: np.ndarray = sp.field(default_factory=lambda: np.zeros(0, dtype=np.int8))
+    # pulse number, 0 excitation, 1 ... etl refocusing pulses, -1 no pulse. verse lobes share the number
+    pulse_num: np.ndarray = sp.field(default_factory=lambda: np.zeros(0, dtype=np.int32))
+    # echo the block belongs to, -1 before the first refocusing
+    echo_num: np.ndarray = sp.field(default_factory=lambda: np.zeros(0, dtype=np.int32))
+    # flip angle and phase of the pulse [rad], 0 for blocks without pulse
+    flip_angle_rad: np.ndarray = sp.field(default_factory=lambda: np.zeros(0))
+    phase_rad: np.ndarray = sp.field(default_factory=lambda: np.zeros(0))
+    # echo centers [us]
+    te_us: np.ndarray = sp.field(default_factory=lambda: np.zeros(0))
+
+    event_types: typing.ClassVar[typing.Tuple[str, ...]] = (
+        "excitation", "excitation_verse_lobe", "rephase", "crush", "refocus", "refocus_verse_lobe", "acquisition"
+    )
+
+    def __len__(self) -> int:
+        return self.start_us.shape[0]
+
+    @property
+    def end_us(self) -> np.ndarray:
+        return self.start_us + self.duration_us
+
+    def select(self, event_type: str) -> np.ndarray:
+        """
+        Rows of all blocks of one event type.
+        """
+        return np.flatnonzero(self.event_type == self.event_types.index(event_type))
+
+    @classmethod
+    def compile(cls, emc) -> "EmcEventTable":
+        """
+        Build the timeline of an EmcParameters instance.
+        Refocusing pulses are centered at (echo + 1/2) * esp after the excitation center with crushers
+        directly before and after, acquisitions are centered at the echo times (echo + 1) * esp.
+        Blocks that do not fit the echo spacing overlap, a warning is logged.
+        """
+        rows: typing.List[tuple] = []
+        types = {name: i for i, name in enumerate(cls.event_types)}
+
+        def add_pulse(start: float, name: str, gradient: float, duration: float, lobe_gradient: float,
+                      lobe_duration: float, rf_index: int, pulse_num: int, echo_num: int, fa: float, phase: float):
+            # verse pulses: lobe | main | lobe, the pulse spans all three blocks
+            blocks = [(name, gradient, duration)]
+            if lobe_duration > 0:
+                lobe = (f"{name}_verse_lobe", lobe_gradient, lobe_duration)
+                blocks = [lobe, blocks[0], lobe]
+            for b_name, b_grad, b_dur in blocks:
+                rows.append((start, b_dur, b_grad, types[b_name], rf_index, pulse_num, echo_num, fa, phase))
+                start += b_dur
+            return start
+
+        t_exc_total = emc.duration_excitation + 2 * emc.duration_excitation_verse_lobes
+        t = add_pulse(
+            0.0, "excitation", emc.gradient_excitation, emc.duration_excitation,
+            emc.gradient_excitation_verse_lobes, emc.duration_excitation_verse_lobes,
+            rf_index=0, pulse_num=0, echo_num=-1,
+            fa=np.deg2rad(emc.excitation_angle), phase=np.deg2rad(emc.excitation_phase)
+        )
+        rows.append((t, emc.duration_excitation_rephase, emc.gradient_excitation_rephase, types["rephase"],
+                     -1, -1, -1, 0.0, 0.0))
+        t += emc.duration_excitation_rephase
+
+        exc_center = t_exc_total / 2
+        esp_us = emc.esp * 1e3
+        t_ref_total = emc.duration_refocus + 2 * emc.duration_refocus_verse_lobes
+        te = exc_center + esp_us * np.arange(1, emc.etl + 1)
+        overlapping = []
+        for echo in range(emc.etl):
+            t_ref_start = exc_center + esp_us * (echo + 0.5) - t_ref_total / 2
+            t_crush_start = t_ref_start - emc.duration_crush
+            t_acq_start = te[echo] - emc.duration_acquisition / 2
+            t_ref_end = t_ref_start + t_ref_total + emc.duration_crush
+            if t_crush_start < t or t_acq_start < t_ref_end:
+                overlapping.append(echo)
+            rows.append((t_crush_start, emc.duration_crush, emc.gradient_crush, types["crush"],
+                         -1, -1, echo, 0.0, 0.0))
+            t = add_pulse(
+                t_ref_start, "refocus", emc.gradient_refocus, emc.duration_refocus,
+                emc.gradient_refocus_verse_lobes, emc.duration_refocus_verse_lobes,
+                rf_index=1, pulse_num=echo + 1, echo_num=echo,
+                fa=np.deg2rad(emc.refocus_angle[min(echo, len(emc.refocus_angle) - 1)]),
+                phase=np.deg2rad(emc.refocus_phase[min(echo, len(emc.refocus_phase) - 1)])
+            )
+            rows.append((t, emc.duration_crush, emc.gradient_crush, types["crush"], -1, -1, echo, 0.0, 0.0))
+            rows.append((t_acq_start, emc.duration_acquisition, emc.gradient_acquisition, types["acquisition"],
+                         -1, -1, echo, 0.0, 0.0))
+            t = t_acq_start + emc.duration_acquisition
+
+        if overlapping:
+            # kept on the esp grid, gradients of overlapping blocks superpose
+            log_module.warning(
+                f"echo spacing {emc.esp} ms too short to fit refocusing, crushers and acquisition without overlap, "
+                f"echoes: {overlapping}"
+            )
+        columns = list(zip(*rows))
+        return cls(
+            start_us=np.array(columns[0], dtype=np.float64),
+            duration_us=np.array(columns[1], dtype=np.float64),
+            gradient_mT_m=np.array(columns[2], dtype=np.float64),
+            event_type=np.array(columns[3], dtype=np.int8),
+            rf_index=np.array(columns[4], dtype=np.int8),
+            pulse_num=np.array(columns[5], dtype=np.int32),
+            echo_num=np.array(columns[6], dtype=np.int32),
+            flip_angle_rad=np.array(columns[7], dtype=np.float64),
+            phase_rad=np.array(columns[8], dtype=np.float64),
+            te_us=te.astype(np.float64)
+        )
@@ -3,6 +3,8 @@ import dataclasses as dc
 import typing
 import logging
 import numpy as np
+from ..instrumentation import instrument
+from .emc_events import EmcEventTable
 log_module = logging.getLogger(__name__)
 
 
@@ -58,6 +60,7 @@ class EmcParameters(sp.helpers.Serializable):
     # echo times
     tes: list = sp.field(default_factory=lambda: [0.0])
 
+    @instrument("EmcParameters.__post_init__")
     def __post_init__(self):
         self.gamma_pi: float = self.gamma_hz * 2 * np.pi
         self.duration_acquisition: float = 1e6 / self.bw  # [us]
@@ -76,3 +79,20 @@ class EmcParameters(sp.helpers.Serializable):
             # fill up list with last value
             self.refocus_angle.append(self.refocus_angle[-1])
             self.refocus_phase.append(self.refocus_phase[-1])
+
+    def _event_table_key(self) -> tuple:
+        values = (getattr(self, f.name) for f in dc.fields(self) if f.name != "tes")
+        return tuple(tuple(v) if isinstance(v, list) else v for v in values)
+
+    def get_event_table(self) -> EmcEventTable:
+        """
+        Compiled event table of the sequence timeline, cached until any timing relevant field changes.
+        """
+        key = self._event_table_key()
+        cached = self.__dict__.get("_event_table")
+        if cached is None or cached[0] != key:
+            # duration of acquisition is derived in post init, refresh in case bw changed
+            self.duration_acquisition = 1e6 / self.bw
+            cached = (key, EmcEventTable.compile(self))
+            self.__dict__["_event_table"] = cached
+        return cached[1]
@@ -3,6 +3,7 @@ import dataclasses as dc
 import typing
 import numpy as np
 import logging
+from ..instrumentation import instrument
 
 log_module = logging.getLogger(__name__)
 
@@ -73,6 +74,14 @@ class PypulseqParameters(sp.helpers.Serializable):
         help="Use Navigator scans on upper and lower slice slab edges to track 2D motion per TR."
     )
 
+    # inputs of the derived quantities supported by sweep
+    _sweep_fields: typing.ClassVar[typing.Tuple[str, ...]] = (
+        "resolution_fov_read", "resolution_fov_phase", "resolution_base", "resolution_slice_thickness",
+        "resolution_slice_num", "resolution_slice_gap", "number_central_lines", "acceleration_factor",
+        "bandwidth", "oversampling"
+    )
+
+    @instrument("PypulseqParameters.__post_init__")
     def __post_init__(self):
         # resolution, number of fe and pe. we want this to be a multiple of 2 for FFT reasoning (have 0 line)
         self.resolution_n_read = int(np.ceil(self.resolution_base / 2) * 2)  # number of freq encodes
@@ -167,9 +176,79 @@ class PypulseqParameters(sp.helpers.Serializable):
 
         # error catches
         if np.any(np.array(self.grad_moment_slice_spoiling) < 1e-7):
-            err = f"this implementation needs a spoiling moment supplied: provide spoiling Moment > 0"
+            err = "this implementation needs a spoiling moment supplied: provide spoiling Moment > 0"
+            log_module.error(err)
+            raise ValueError(err)
+
+    @classmethod
+    def sweep(cls, grid: bool = False, **inputs) -> typing.Dict[str, np.ndarray]:
+        """
+        Compute the derived protocol quantities of __post_init__ for many input combinations at once.
+        No instances are built and nothing is logged, results equal the scalar derivation.
+        Sweepable inputs (others keep their defaults): resolution_fov_read, resolution_fov_phase, resolution_base,
+        resolution_slice_thickness, resolution_slice_num, resolution_slice_gap, number_central_lines,
+        acceleration_factor, bandwidth, oversampling.
+        :param grid: if True all combinations of the given 1D inputs are evaluated (ij indexing, axis per input
+            in given order), otherwise the inputs are broadcast against each other
+        :param inputs: scalars or arrays of the sweepable fields
+        :return: arrays of the (updated) inputs and derived quantities, keyed by attribute name.
+            All arrays have the common sweep shape, they are read only broadcast views
+            where a quantity does not depend on all inputs
+        """
+        defaults = {
+            f.name: f.default for f in dc.fields(cls) if f.name in cls._sweep_fields
+        }
+        unknown = set(inputs.keys()).difference(defaults.keys())
+        if unknown:
+            err = f"can not sweep fields {sorted(unknown)}, choose from {list(defaults.keys())}"
             log_module.error(err)
             raise ValueError(err)
+        if grid:
+            axes = np.meshgrid(*[np.asarray(v).reshape(-1) for v in inputs.values()], indexing="ij", sparse=True)
+            inputs = dict(zip(inputs.keys(), axes))
+        v = {key: np.asarray(inputs.get(key, default)) for key, default in defaults.items()}
+
+        # resolution, even number of frequency encodes, update fov for constant voxel size
+        base = v["resolution_base"].astype(np.int64)
+        n_read = (np.ceil(base / 2) * 2).astype(np.int64)
+        fov_read = np.where(np.abs(n_read - base) > 0, v["resolution_fov_read"] * (n_read / base),
+                            v["resolution_fov_read"])
+        base = n_read
+        # even number of phase encodes, update fov phase percentage
+        n_phase_f = base * v["resolution_fov_phase"] / 100
+        n_phase = (np.ceil(n_phase_f / 2) * 2).astype(np.int64)
+        fov_phase = np.where(np.abs(n_phase - np.trunc(n_phase_f)) > 0, n_phase / n_read * 100,
+                             v["resolution_fov_phase"])
+        z_extend = v["resolution_slice_thickness"] * (
+                v["resolution_slice_num"] + v["resolution_slice_gap"] / 100.0 * (v["resolution_slice_num"] - 1)
+        )
+        number_outer_lines = np.rint((n_phase - v["number_central_lines"]) / v["acceleration_factor"]).astype(np.int64)
+        # dwell on adc raster, adapt acquisition time and bandwidth
+        adc_raster = 1e-7
+        s_dwell = 1 / v["bandwidth"] / n_read / v["oversampling"]
+        adcr_dwell = (np.floor(s_dwell / adc_raster / 2) * 2).astype(np.int64)
+        dwell = adc_raster * adcr_dwell
+        acquisition_time = dwell * n_read * v["oversampling"]
+
+        result = {
+            "resolution_base": base,
+            "resolution_n_read": n_read,
+            "resolution_n_phase": n_phase,
+            "resolution_fov_read": fov_read,
+            "resolution_fov_phase": fov_phase,
+            "resolution_voxel_size_read": fov_read / base,
+            "resolution_voxel_size_phase": fov_read / base,
+            "delta_k_read": 1e3 / fov_read,
+            "delta_k_phase": 1e3 / (fov_read * fov_phase / 100.0),
+            "z_extend": z_extend,
+            "number_outer_lines": number_outer_lines,
+            "dwell": dwell,
+            "acquisition_time": acquisition_time,
+            "bandwidth": 1 / acquisition_time,
+        }
+        # broadcast everything to the common sweep shape
+        shape = np.broadcast_shapes(*[a.shape for a in list(v.values()) + list(result.values())])
+        return {key: np.broadcast_to(value, shape) for key, value in result.items()}
 
     def get_voxel_size(self, write_log: bool = False):
         msg = (
@@ -7,6 +7,9 @@ import logging
 
 log_module = logging.getLogger(__name__)
 
+# number of set bits per byte value
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1)
+
 
 @dc.dataclass
 class ImageAcqParameters(sp.helpers.Serializable):
@@ -36,10 +39,70 @@ class NavigatorAcqParameters(ImageAcqParameters):
     nav_resolution_scaling: float = 0.0
 
 
+@dc.dataclass
+class SamplingMask(sp.helpers.Serializable):
+    """
+    Boolean mask of acquired phase encode lines, shape (n_slice, n_echo, n_phase).
+    Stored bit-packed along the phase axis, a (slice, echo) line set is unpacked on its own.
+    """
+    # (n_slice, n_echo, n_phase)
+    shape: list = sp.field(default_factory=lambda: [0, 0, 0])
+    # packed bits, shape (n_slice, n_echo, ceil(n_phase / 8))
+    bits: np.ndarray = sp.field(default_factory=lambda: np.zeros((0, 0, 0), dtype=np.uint8))
+
+    def __post_init__(self):
+        packed_shape = (self.shape[0], self.shape[1], (self.shape[2] + 7) // 8)
+        # decoded from json as nested int lists
+        bits = np.asarray(self.bits, dtype=np.uint8)
+        if bits.size == 0:
+            # no lines, or bits set after init when loaded from a binary container
+            bits = np.zeros(packed_shape, dtype=np.uint8)
+        self.bits = bits.reshape(packed_shape)
+
+    @classmethod
+    def from_lines(cls, shape: typing.Tuple[int, int, int], slice_num: np.ndarray, echo_num: np.ndarray,
+                   pe_num: np.ndarray):
+        """
+        Build from the (slice, echo, phase encode) indices of all acquired lines.
+        """
+        shape = tuple(int(n) for n in shape)
+        mask = np.zeros(shape, dtype=bool)
+        mask[slice_num, echo_num, pe_num] = True
+        return cls(shape=list(shape), bits=np.packbits(mask, axis=-1))
+
+    @property
+    def n_phase(self) -> int:
+        return self.shape[2]
+
+    def get(self, slice_num: int, echo_num: int) -> np.ndarray:
+        """
+        Acquired lines of one slice and echo as boolean array of shape (n_phase,).
+        """
+        return np.unpackbits(self.bits[slice_num, echo_num], count=self.n_phase).astype(bool)
+
+    def lines(self, slice_num: int, echo_num: int) -> np.ndarray:
+        """
+        Phase encode numbers acquired for one slice and echo.
+        """
+        return np.flatnonzero(self.get(slice_num, echo_num))
+
+    def num_lines(self) -> np.ndarray:
+        """
+        Number of acquired lines per slice and echo, shape (n_slice, n_echo), computed on the packed bits.
+        """
+        return _POPCOUNT[self.bits].sum(axis=-1)
+
+    def to_array(self) -> np.ndarray:
+        return np.unpackbits(self.bits, axis=-1, count=self.n_phase).astype(bool)
+
+
 @dc.dataclass
 class ReconParameters(sp.Serializable):
     multi_echo_img: ImageAcqParameters = ImageAcqParameters()
     navigator_img: NavigatorAcqParameters = NavigatorAcqParameters()
+    # acquired lines of the image and navigator scans, see build_sampling_masks
+    sampling_mask: SamplingMask = sp.field(default_factory=SamplingMask)
+    navigator_mask: SamplingMask = sp.field(default_factory=SamplingMask)
 
     def set_recon_params(
             self, img_n_read: int, img_n_phase: int, img_n_slice: int, img_resolution_read: float,
@@ -83,3 +146,58 @@ class ReconParameters(sp.Serializable):
             self.navigator_img.os_factor = os_factor
         else:
             self.navigator_img.os_factor = self.multi_echo_img.os_factor
+
+    @staticmethod
+    def _mask_from_rows(acq: ImageAcqParameters, slice_num: np.ndarray, echo_num: np.ndarray,
+                        pe_num: np.ndarray, name: str) -> SamplingMask:
+        shape = (acq.n_slice, max(acq.etl, 1), acq.n_phase)
+        if min(shape) < 1:
+            err = f"{name} dimensions not set (n_slice, etl, n_phase = {shape})"
+            log_module.error(err)
+            raise ValueError(err)
+        if shape[1] == 1:
+            # single echo acquisition
+            echo_num = np.zeros_like(echo_num)
+        valid = (
+            (slice_num >= 0) & (slice_num < shape[0]) & (echo_num >= 0) & (echo_num < shape[1]) &
+            (pe_num >= 0) & (pe_num < shape[2])
+        )
+        num_invalid = int(valid.shape[0] - np.count_nonzero(valid))
+        if num_invalid > 0:
+            log_module.warning(f"{name}: {num_invalid} sampling pattern rows outside of dimensions {shape} ignored")
+        return SamplingMask.from_lines(shape, slice_num[valid], echo_num[valid], pe_num[valid])
+
+    def build_sampling_masks(self, sampling_k_traj) -> typing.Tuple[SamplingMask, SamplingMask]:
+        """
+        Build the masks of acquired lines from the sampling pattern and set them.
+        Image scans fill sampling_mask with the multi_echo_img dimensions,
+        navigator scans (nav_acq) fill navigator_mask with the navigator_img dimensions.
+        The masks are cached until the sampling pattern or the dimensions change.
+        :param sampling_k_traj: SamplingKTrajectoryParameters holding the sampling pattern
+        :return: sampling_mask, navigator_mask
+        """
+        buffer = sampling_k_traj.get_sampling_pattern_buffer()
+        dims = (
+            self.multi_echo_img.n_slice, self.multi_echo_img.etl, self.multi_echo_img.n_phase,
+            self.navigator_img.n_slice, self.navigator_img.etl, self.navigator_img.n_phase
+        )
+        cached = self.__dict__.get("_mask_cache")
+        if cached is not None and cached[0] is buffer and cached[1] == (buffer.version, dims):
+            return self.sampling_mask, self.navigator_mask
+
+        slice_num = buffer.codes("slice_num")
+        echo_num = buffer.codes("echo_num")
+        pe_num = buffer.codes("pe_num")
+        nav = buffer.codes("nav_acq").astype(bool)
+        img = ~nav
+        self.sampling_mask = self._mask_from_rows(
+            self.multi_echo_img, slice_num[img], echo_num[img], pe_num[img], name="image sampling mask"
+        )
+        if np.any(nav):
+            self.navigator_mask = self._mask_from_rows(
+                self.navigator_img, slice_num[nav], echo_num[nav], pe_num[nav], name="navigator sampling mask"
+            )
+        else:
+            self.navigator_mask = SamplingMask()
+        self._mask_cache = (buffer, (buffer.version, dims))
+        return self.sampling_mask, self.navigator_mask
@@ -0,0 +1,265 @@
+"""
+Pulse bank: many RF pulse waveforms in one ragged array store with an index over
+name, duration, bandwidth and time-bandwidth product.
+Banks are saved as binary container and memory-mapped on open,
+bulk operations work on all waveforms at once.
+"""
+import logging
+import pathlib as plib
+import typing
+
+import numpy as np
+
+from . import binary
+from .rf_params import GlobalSystem, RFPulse
+
+log_module = logging.getLogger(__name__)
+
+
+class RFPulseBank:
+    """
+    Waveforms of all pulses are concatenated in one amplitude and one phase array,
+    offsets give the sample range of each pulse.
+    """
+    spec_keys: typing.Tuple[str, ...] = ("duration_in_us", "bandwidth_in_Hz", "time_bandwidth")
+
+    def __init__(self, names: typing.List[str],
+                 duration_in_us: np.ndarray, bandwidth_in_Hz: np.ndarray, time_bandwidth: np.ndarray,
+                 offsets: np.ndarray, amplitude: np.ndarray, phase: np.ndarray):
+        self.names: typing.List[str] = list(names)
+        self.duration_in_us: np.ndarray = np.asarray(duration_in_us, dtype=np.float64)
+        self.bandwidth_in_Hz: np.ndarray = np.asarray(bandwidth_in_Hz, dtype=np.float64)
+        self.time_bandwidth: np.ndarray = np.asarray(time_bandwidth, dtype=np.float64)
+        self.offsets: np.ndarray = np.asarray(offsets, dtype=np.int64)
+        self.amplitude: np.ndarray = amplitude
+        self.phase: np.ndarray = phase
+        if self.offsets.shape[0] != len(self.names) + 1 or self.offsets[-1] != self.amplitude.shape[0]:
+            err = f"pulse bank offsets do not match number of pulses ({len(self.names)}) or samples"
+            log_module.error(err)
+            raise ValueError(err)
+        if self.amplitude.shape != self.phase.shape:
+            err = "shape of amplitude and phase do not match"
+            log_module.error(err)
+            raise ValueError(err)
+        self._index: typing.Dict[str, int] = {name: i for i, name in enumerate(self.names)}
+        if len(self._index) != len(self.names):
+            err = "pulse names in bank are not unique"
+            log_module.error(err)
+            raise ValueError(err)
+        # sort order and sorted values per spec, built on first query
+        self._sorted: typing.Dict[str, typing.Tuple[np.ndarray, np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._index
+
+    @property
+    def num_samples(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @property
+    def waveform_dtype(self) -> str:
+        return "float32" if self.amplitude.dtype == np.float32 else "float64"
+
+    def with_waveform_dtype(self, waveform_dtype: str):
+        """
+        Get the bank with amplitude and phase stored as float32 (halves memory and file size) or float64,
+        see RFPulse.waveform_dtype for the precision.
+        """
+        dtype = RFPulse.waveform_dtypes.get(waveform_dtype)
+        if dtype is None:
+            err = f"waveform dtype {waveform_dtype} not supported, choose from {list(RFPulse.waveform_dtypes)}"
+            log_module.error(err)
+            raise ValueError(err)
+        return RFPulseBank(
+            names=self.names, duration_in_us=self.duration_in_us, bandwidth_in_Hz=self.bandwidth_in_Hz,
+            time_bandwidth=self.time_bandwidth, offsets=self.offsets,
+            amplitude=self.amplitude.astype(dtype, copy=False), phase=self.phase.astype(dtype, copy=False)
+        )
+
+    @classmethod
+    def from_pulses(cls, pulses: typing.Iterable[RFPulse]):
+        pulses = list(pulses)
+        num_samples = np.array([p.amplitude.shape[0] for p in pulses], dtype=np.int64)
+        offsets = np.zeros(len(pulses) + 1, dtype=np.int64)
+        np.cumsum(num_samples, out=offsets[1:])
+        names = [p.name if p.name else f"pulse_{i}" for i, p in enumerate(pulses)]
+        return cls(
+            names=names,
+            duration_in_us=np.array([p.duration_in_us for p in pulses]),
+            bandwidth_in_Hz=np.array([p.bandwidth_in_Hz for p in pulses]),
+            time_bandwidth=np.array([p.time_bandwidth for p in pulses]),
+            offsets=offsets,
+            amplitude=np.concatenate([p.amplitude for p in pulses]) if pulses else np.zeros(0),
+            phase=np.concatenate([p.phase for p in pulses]) if pulses else np.zeros(0)
+        )
+
+    @classmethod
+    def from_directory(cls, path: typing.Union[str, plib.Path], pattern: str = "*.pta",
+                       bandwidth_in_Hz: float = None, duration_in_us: int = None, time_bandwidth: float = None,
+                       max_workers: int = None, waveform_dtype: str = "float64"):
+        """
+        Build a bank from all pulse files of a directory, files are parsed in parallel.
+        :param waveform_dtype: storage dtype of amplitude and phase, "float32" for compact banks
+        """
+        pulses = RFPulse.load_directory(
+            path=path, pattern=pattern, bandwidth_in_Hz=bandwidth_in_Hz, duration_in_us=duration_in_us,
+            time_bandwidth=time_bandwidth, max_workers=max_workers, waveform_dtype=waveform_dtype
+        )
+        return cls.from_pulses(pulses.values())
+
+    def save(self, path: typing.Union[str, plib.Path]):
+        log_module.info(f"write pulse bank ({len(self)} pulses): {plib.Path(path).as_posix()}")
+        arrays = {key: self.__getattribute__(key) for key in self.spec_keys}
+        arrays.update({"offsets": self.offsets, "amplitude": self.amplitude, "phase": self.phase})
+        binary.write_container(path, meta={"class": type(self).__qualname__, "names": self.names}, arrays=arrays)
+
+    @classmethod
+    def open(cls, path: typing.Union[str, plib.Path], mmap: bool = True):
+        """
+        Open a saved bank, waveforms are memory-mapped read only.
+        """
+        meta, arrays = binary.read_container(path, mmap=mmap)
+        if meta.get("class") != cls.__qualname__:
+            err = f"{path} does not hold a pulse bank"
+            log_module.error(err)
+            raise TypeError(err)
+        return cls(names=meta["names"], **arrays)
+
+    def index(self, name: str) -> int:
+        idx = self._index.get(name)
+        if idx is None:
+            err = f"pulse {name} not in bank"
+            log_module.error(err)
+            raise KeyError(err)
+        return idx
+
+    def _idx(self, key: typing.Union[str, int]) -> int:
+        if isinstance(key, str):
+            return self.index(key)
+        return int(key)
+
+    def get_amplitude(self, key: typing.Union[str, int]) -> np.ndarray:
+        idx = self._idx(key)
+        return self.amplitude[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def get_phase(self, key: typing.Union[str, int]) -> np.ndarray:
+        idx = self._idx(key)
+        return self.phase[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def get_pulse(self, key: typing.Union[str, int]) -> RFPulse:
+        """
+        Get a pulse by name or index. The waveforms are views into the bank, no copy is made.
+        """
+        idx = self._idx(key)
+        amplitude = self.get_amplitude(idx)
+        return RFPulse(
+            name=self.names[idx], bandwidth_in_Hz=float(self.bandwidth_in_Hz[idx]),
+            duration_in_us=float(self.duration_in_us[idx]), time_bandwidth=float(self.time_bandwidth[idx]),
+            num_samples=amplitude.shape[0], amplitude=amplitude, phase=self.get_phase(idx),
+            waveform_dtype=self.waveform_dtype
+        )
+
+    def _sorted_spec(self, key: str) -> typing.Tuple[np.ndarray, np.ndarray]:
+        sorted_spec = self._sorted.get(key)
+        if sorted_spec is None:
+            order = np.argsort(self.__getattribute__(key), kind="stable")
+            sorted_spec = (order, self.__getattribute__(key)[order])
+            self._sorted[key] = sorted_spec
+        return sorted_spec
+
+    def select(self, duration_in_us: typing.Tuple[float, float] = None,
+               bandwidth_in_Hz: typing.Tuple[float, float] = None,
+               time_bandwidth: typing.Tuple[float, float] = None) -> np.ndarray:
+        """
+        Find pulses with specs in the given closed ranges, unset specs are not restricted.
+        :return: sorted indices of matching pulses
+        """
+        selection = np.arange(len(self))
+        for key, bounds in zip(self.spec_keys, (duration_in_us, bandwidth_in_Hz, time_bandwidth)):
+            if bounds is None:
+                continue
+            order, values = self._sorted_spec(key)
+            start = np.searchsorted(values, bounds[0], side="left")
+            stop = np.searchsorted(values, bounds[1], side="right")
+            selection = np.intersect1d(selection, order[start:stop], assume_unique=True)
+        return selection
+
+    def subset(self, indices: typing.Union[np.ndarray, typing.List[int]]):
+        """
+        Copy the given pulses into a new bank.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        num_samples = self.num_samples[indices]
+        offsets = np.zeros(indices.shape[0] + 1, dtype=np.int64)
+        np.cumsum(num_samples, out=offsets[1:])
+        # sample positions of the selected pulses in the source arrays
+        src = np.repeat(self.offsets[indices] - offsets[:-1], num_samples) + np.arange(offsets[-1])
+        return RFPulseBank(
+            names=[self.names[i] for i in indices], duration_in_us=self.duration_in_us[indices],
+            bandwidth_in_Hz=self.bandwidth_in_Hz[indices], time_bandwidth=self.time_bandwidth[indices],
+            offsets=offsets, amplitude=self.amplitude[src], phase=self.phase[src]
+        )
+
+    def resample_on_raster(self, raster_time_s: float):
+        """
+        Interpolate all pulses onto the raster at once, same result as RFPulse.set_shape_on_raster per pulse.
+        :return: new bank holding the resampled waveforms
+        """
+        n_src = self.num_samples
+        if np.any(n_src == 0):
+            err = f"can not resample pulses without samples: {[self.names[i] for i in np.flatnonzero(n_src == 0)]}"
+            log_module.error(err)
+            raise ValueError(err)
+        n_new = (self.duration_in_us * 1e-6 / raster_time_s).astype(np.int64)
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(n_new, out=offsets[1:])
+        pulse_idx = np.repeat(np.arange(len(self)), n_new)
+        # sample position within each pulse, equals np.linspace(0, n_src, n_new)
+        j = np.arange(offsets[-1]) - offsets[:-1][pulse_idx]
+        step = n_src / np.maximum(n_new - 1, 1)
+        x = j * step[pulse_idx]
+        # linspace hits the end point exactly
+        multi = n_new > 1
+        x[offsets[1:][multi] - 1] = n_src[multi]
+        # interpolate, positions beyond the last sample are clamped as in np.interp
+        n_pulse = n_src[pulse_idx]
+        k = np.minimum(np.floor(x).astype(np.int64), n_pulse - 1)
+        frac = np.where(k < n_pulse - 1, x - k, 0.0)
+        k_next = np.minimum(k + 1, n_pulse - 1)
+        base = self.offsets[:-1][pulse_idx]
+        waveforms = []
+        for data in (self.amplitude, self.phase):
+            lo = data[base + k].astype(np.float64)
+            waveforms.append((lo + frac * (data[base + k_next] - lo)).astype(data.dtype, copy=False))
+        return RFPulseBank(
+            names=self.names, duration_in_us=self.duration_in_us, bandwidth_in_Hz=self.bandwidth_in_Hz,
+            time_bandwidth=self.time_bandwidth, offsets=offsets, amplitude=waveforms[0], phase=waveforms[1]
+        )
+
+    def set_flip_angle(self, flip_angle_rad: typing.Union[float, np.ndarray]):
+        """
+        Scale all pulses to the flip angle(s) at once, same result as RFPulse.set_flip_angle per pulse.
+        :param flip_angle_rad: one flip angle for all pulses or one per pulse
+        :return: new bank holding the scaled amplitudes
+        """
+        flip_angle_rad = np.broadcast_to(np.asarray(flip_angle_rad, dtype=np.float64), (len(self),))
+        gamma_pi = GlobalSystem().gamma_Hz * 2 * np.pi
+        n_src = self.num_samples
+        if np.any(n_src == 0):
+            err = "can not set flip angle of pulses without samples"
+            log_module.error(err)
+            raise ValueError(err)
+        starts = self.offsets[:-1]
+        norm = np.sqrt(np.add.reduceat(self.amplitude.astype(np.float64) ** 2, starts))
+        delta_t_us = self.duration_in_us / n_src
+        # flip angle of the normalized shapes
+        flip_angle_normalized = np.add.reduceat(np.abs(self.amplitude), starts) / norm * gamma_pi * delta_t_us * 1e-6
+        scale = flip_angle_rad / flip_angle_normalized / norm
+        amplitude = (self.amplitude * np.repeat(scale, n_src)).astype(self.amplitude.dtype, copy=False)
+        return RFPulseBank(
+            names=self.names, duration_in_us=self.duration_in_us, bandwidth_in_Hz=self.bandwidth_in_Hz,
+            time_bandwidth=self.time_bandwidth, offsets=self.offsets, amplitude=amplitude, phase=self.phase
+        )
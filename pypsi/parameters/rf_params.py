@@ -1,15 +1,86 @@
+import concurrent.futures
 import dataclasses as dc
 import logging
+import os
+import re
+import warnings
+import zlib
 
 import numpy as np
 import pathlib as plib
 import typing
-import pandas as pd
-import plotly.express as px
 import simple_parsing as sp
+from ..lazy_import import lazy_import
+from .binary import BinarySerializable
+
+# pandas and plotly are only imported for display and plotting
+pd = lazy_import("pandas")
+px = lazy_import("plotly.express")
 
 log_module = logging.getLogger(__name__)
 
+# first data line: leading token is an unsigned number, header lines are skipped up to there
+_PULSE_DATA_LINE = re.compile(rb"^[ \t]*(?:\d+\.?\d*|\.\d+)(?:[ \t;]|\r?$)")
+# trailing comments in .pta files, eg. "; (0)"
+_PULSE_COMMENT = re.compile(rb";[^\n]*")
+
+
+def _parse_pulse_chunk(chunk: bytes, f_name: plib.Path) -> np.ndarray:
+    with warnings.catch_warnings():
+        # numpy warns about unparsable content instead of raising (for now)
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            return np.fromstring(_PULSE_COMMENT.sub(b"", chunk), sep=" ")
+        except (DeprecationWarning, ValueError):
+            err = f"could not parse pulse data in file {f_name}"
+            log_module.error(err)
+            raise ValueError(err)
+
+
+def read_pulse_file(f_name: typing.Union[str, plib.Path], chunk_size: int = 1 << 20) -> np.ndarray:
+    """
+    Read the numeric columns of a .txt or .pta pulse file.
+    Header lines are skipped, the data is parsed in chunks of chunk_size bytes,
+    hence very large files are streamed instead of read as a whole.
+    :param f_name: file name
+    :param chunk_size: bytes read per chunk
+    :return: array of shape (num_samples, num_columns)
+    """
+    f_name = plib.Path(f_name)
+    parts = []
+    num_columns = 0
+    with open(f_name, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        # skip header
+        for line in f:
+            if _PULSE_DATA_LINE.match(line):
+                num_columns = len(_PULSE_COMMENT.sub(b"", line).split())
+                parts.append(_parse_pulse_chunk(line, f_name))
+                break
+        rest = b""
+        while num_columns > 0:
+            # the read buffer is allocated at the requested size, do not ask for more than is left
+            chunk = f.read(max(min(chunk_size, file_size - f.tell()), 1))
+            if not chunk:
+                break
+            chunk = rest + chunk
+            # only parse complete lines, carry the remainder
+            end = chunk.rfind(b"\n") + 1
+            rest = chunk[end:]
+            parts.append(_parse_pulse_chunk(chunk[:end], f_name))
+        if rest:
+            parts.append(_parse_pulse_chunk(rest, f_name))
+    if num_columns == 0:
+        err = f"no pulse data found in file {f_name}"
+        log_module.error(err)
+        raise ValueError(err)
+    data = np.concatenate(parts)
+    if data.shape[0] % num_columns != 0:
+        err = f"inconsistent number of columns in pulse file {f_name}"
+        log_module.error(err)
+        raise ValueError(err)
+    return data.reshape(-1, num_columns)
+
 
 @dc.dataclass
 class GlobalSystem:
@@ -29,15 +100,52 @@ class RFPulse(sp.helpers.Serializable):
     time_bandwidth: float = bandwidth_in_Hz * duration_in_us * 1e-6
     num_samples: int = int(duration_in_us)
 
-    amplitude: np.ndarray = np.zeros(num_samples)
-    phase: np.ndarray = np.zeros(num_samples)
+    # allocated per instance in __post_init__, a class level array would be shared by all instances
+    amplitude: np.ndarray = sp.field(default_factory=lambda: np.zeros(0))
+    phase: np.ndarray = sp.field(default_factory=lambda: np.zeros(0))
+    # storage dtype of amplitude and phase, "float32" halves memory and binary file size.
+    # computations run in float64 and are rounded once when stored,
+    # float32 samples carry a relative error of at most 2^-24 (phase: at most pi * 2^-24 rad)
+    waveform_dtype: str = sp.field(default="float64", choices=["float64", "float32"])
+
+    waveform_dtypes: typing.ClassVar[typing.Dict[str, type]] = {"float64": np.float64, "float32": np.float32}
 
     def __post_init__(self):
+        if self.waveform_dtype not in self.waveform_dtypes:
+            err = f"waveform dtype {self.waveform_dtype} not supported, choose from {list(self.waveform_dtypes)}"
+            log_module.error(err)
+            raise ValueError(err)
         # check array sizes - for some reason this is not working properly when creating class with input args
         if self.amplitude.shape[0] != self.num_samples:
             self.amplitude = np.zeros(self.num_samples)
         if self.phase.shape[0] != self.num_samples:
             self.phase = np.zeros(self.num_samples)
+        self.amplitude = self._as_stored(self.amplitude)
+        self.phase = self._as_stored(self.phase)
+
+    def _as_stored(self, data: np.ndarray) -> np.ndarray:
+        # no copy if the dtype matches already (eg. memory-mapped arrays)
+        return np.asarray(data, dtype=self.waveform_dtypes[self.waveform_dtype])
+
+    def set_waveform_dtype(self, waveform_dtype: str):
+        """
+        Switch the storage dtype of amplitude and phase, see waveform_dtype.
+        """
+        if waveform_dtype not in self.waveform_dtypes:
+            err = f"waveform dtype {waveform_dtype} not supported, choose from {list(self.waveform_dtypes)}"
+            log_module.error(err)
+            raise ValueError(err)
+        self.waveform_dtype = waveform_dtype
+        self.amplitude = self._as_stored(self.amplitude)
+        self.phase = self._as_stored(self.phase)
+
+    def get_waveform(self, dtype=np.complex128) -> np.ndarray:
+        """
+        Complex waveform amplitude * exp(i phase).
+        :param dtype: complex dtype, np.complex64 halves the size
+        """
+        waveform = self.amplitude.astype(np.float64) * np.exp(1j * self.phase.astype(np.float64))
+        return waveform.astype(dtype, copy=False)
 
     def display(self):
         columns = {
@@ -52,34 +160,78 @@ class RFPulse(sp.helpers.Serializable):
     def set_shape_on_raster(self, raster_time_s):
         # interpolate shape to duration raster
         N = int(self.duration_in_us * 1e-6 / raster_time_s)
-        self.amplitude = np.interp(
+        self.amplitude = self._as_stored(np.interp(
             np.linspace(0, self.amplitude.shape[0], N),
             np.arange(self.amplitude.shape[0]),
             self.amplitude
-        )
-        self.phase = np.interp(
+        ))
+        self.phase = self._as_stored(np.interp(
             np.linspace(0, self.phase.shape[0], N),
             np.arange(self.phase.shape[0]),
             self.phase
-        )
+        ))
         self.num_samples = N
 
+    def _amplitude_key(self) -> tuple:
+        # content fingerprint of the amplitude and timing, in place edits of the amplitude change it as well
+        amplitude = np.ascontiguousarray(self.amplitude)
+        return (
+            self.duration_in_us, self.num_samples, amplitude.dtype.str, amplitude.shape,
+            zlib.crc32(amplitude.view(np.uint8).reshape(-1))
+        )
+
+    def _get_normalized_shape(self) -> typing.Tuple[np.ndarray, float]:
+        key = self._amplitude_key()
+        cache = self.__dict__.get("_normalization_cache")
+        if cache is None or cache[0] != key:
+            gamma_pi = GlobalSystem().gamma_Hz * 2 * np.pi
+            delta_t_us = self.duration_in_us / self.num_samples
+            # normalize shape
+            amplitude = self.amplitude.astype(np.float64, copy=False)
+            normalized_shape = amplitude / np.linalg.norm(amplitude)
+            # calculate flip angle
+            flip_angle_normalized_shape = np.sum(np.abs(normalized_shape * gamma_pi)) * delta_t_us * 1e-6
+            cache = (key, normalized_shape, flip_angle_normalized_shape)
+            self._normalization_cache = cache
+        return cache[1], cache[2]
+
     def set_flip_angle(self, flip_angle_rad: float):
-        gamma_pi = GlobalSystem().gamma_Hz * 2 * np.pi
-        delta_t_us = self.duration_in_us / self.num_samples
-        # normalize shape
-        normalized_shape = self.amplitude / np.linalg.norm(self.amplitude)
-        # calculate flip angle
-        flip_angle_normalized_shape = np.sum(np.abs(normalized_shape * gamma_pi)) * delta_t_us * 1e-6
+        normalized_shape, flip_angle_normalized_shape = self._get_normalized_shape()
         # set to new flip angle
-        self.amplitude = flip_angle_rad / flip_angle_normalized_shape * normalized_shape
+        self.amplitude = self._as_stored(flip_angle_rad / flip_angle_normalized_shape * normalized_shape)
+        if flip_angle_rad > 0:
+            # positive scaling keeps the normalized shape
+            self._normalization_cache = (self._amplitude_key(), normalized_shape, flip_angle_normalized_shape)
+
+    def get_flip_angle_train(self, flip_angles_rad: typing.Union[typing.List, np.ndarray],
+                             phases_rad: typing.Union[typing.List, np.ndarray] = None) -> np.ndarray:
+        """
+        Get the pulse scaled to each of the flip angles, eg. for all pulses of a refocusing train.
+        The pulse itself is not changed, the normalization is computed once and cached.
+        :param flip_angles_rad: flip angles [rad], shape (n_angles,)
+        :param phases_rad: optional pulse phase offsets [rad] per flip angle,
+            if given complex waveforms amplitude * exp(i(phase + offset)) are returned
+        :return: amplitudes of shape (n_angles, num_samples), complex if phases given.
+            Returned in the waveform dtype (complex64 for float32 waveforms)
+        """
+        normalized_shape, flip_angle_normalized_shape = self._get_normalized_shape()
+        flip_angles_rad = np.asarray(flip_angles_rad, dtype=np.float64).reshape(-1)
+        scale = flip_angles_rad / flip_angle_normalized_shape
+        dtype = self.waveform_dtypes[self.waveform_dtype]
+        if phases_rad is None:
+            return np.outer(scale, normalized_shape).astype(dtype, copy=False)
+        phases_rad = np.broadcast_to(np.asarray(phases_rad, dtype=np.float64).reshape(-1), flip_angles_rad.shape)
+        train = np.outer(scale * np.exp(1j * phases_rad), normalized_shape * np.exp(1j * self.phase.astype(np.float64)))
+        return train.astype(np.result_type(dtype, np.complex64), copy=False)
 
     @classmethod
     def load_from_txt(cls, f_name: typing.Union[str, plib.Path],
                       bandwidth_in_Hz: float = None,
                       duration_in_us: int = None,
                       time_bandwidth: float = None,
-                      num_samples: int = None):
+                      num_samples: int = None,
+                      chunk_size: int = 1 << 20,
+                      waveform_dtype: str = "float64"):
         """
         read file from .txt or .pta. Need to fill the additional specs.
         :param f_name: file name
@@ -87,6 +239,8 @@ class RFPulse(sp.helpers.Serializable):
         :param duration_in_us:  Duration in microseconds (optional if bandwidth and tbw provided)
         :param time_bandwidth: Time Bandwidth product unitless (optional if bandwidth and duration provided)
         :param num_samples: number of samples of pulse optional, if None pulse sampled per microsecond
+        :param chunk_size: bytes parsed at once, large files are streamed
+        :param waveform_dtype: storage dtype of amplitude and phase, "float32" for compact pulses
         :return:
         """
         if bandwidth_in_Hz is None:
@@ -103,37 +257,27 @@ class RFPulse(sp.helpers.Serializable):
             duration_in_us = int(1e6 * time_bandwidth / bandwidth_in_Hz)
         else:
             time_bandwidth = bandwidth_in_Hz * duration_in_us * 1e-6
-        rf_cls = cls(bandwidth_in_Hz=bandwidth_in_Hz, duration_in_us=duration_in_us, time_bandwidth=time_bandwidth)
+        rf_cls = cls(
+            bandwidth_in_Hz=bandwidth_in_Hz, duration_in_us=duration_in_us, time_bandwidth=time_bandwidth,
+            waveform_dtype=waveform_dtype
+        )
         if num_samples is None:
             num_samples = duration_in_us
         t_name = plib.Path(f_name).absolute()
         if t_name.is_file():
-            # load file content
-            ext_file = plib.Path(t_name)
-            with open(ext_file, "r") as f:
-                content = f.readlines()
-
-            # find line where actual data starts
-            start_count = -1
-            while True:
-                start_count += 1
-                line = content[start_count]
-                start_line = line.strip().split('\t')[0]
-                if start_line.replace('.', '', 1).isdigit():
-                    break
-
-            # read to array
-            if content.__len__() != num_samples:
+            # parse amplitude and phase columns in one pass
+            content = read_pulse_file(t_name, chunk_size=chunk_size)
+            if content.shape[1] < 2:
+                err = f"pulse file {t_name} needs amplitude and phase columns"
+                log_module.error(err)
+                raise AttributeError(err)
+            if content.shape[0] != num_samples:
                 log_module.info(f"file content not matching number of samples given {num_samples}")
-                num_samples = content.__len__() - start_count
+                num_samples = content.shape[0]
                 log_module.info(f"adjusting number of samples to {num_samples}")
-                rf_cls.num_samples = num_samples
-            content = content[start_count:start_count + num_samples]
-            temp_amp = np.array([float(line.strip().split('\t')[0]) for line in content])
-            temp_phase = np.array([float(line.strip().split('\t')[1]) for line in content])
-
-            rf_cls.amplitude = temp_amp
-            rf_cls.phase = temp_phase
+            rf_cls.num_samples = num_samples
+            rf_cls.amplitude = rf_cls._as_stored(np.ascontiguousarray(content[:, 0]))
+            rf_cls.phase = rf_cls._as_stored(np.ascontiguousarray(content[:, 1]))
         else:
             err = f"no file ({t_name}) found or non valid file type"
             log_module.error(err)
@@ -152,6 +296,46 @@ class RFPulse(sp.helpers.Serializable):
             rf_cls.num_samples = int(rf_cls.duration_in_us)
         return rf_cls
 
+    @classmethod
+    def load_directory(cls, path: typing.Union[str, plib.Path], pattern: str = "*.pta",
+                       bandwidth_in_Hz: float = None,
+                       duration_in_us: int = None,
+                       time_bandwidth: float = None,
+                       max_workers: int = None,
+                       waveform_dtype: str = "float64") -> typing.Dict[str, "RFPulse"]:
+        """
+        read all pulse files of a directory in parallel. The specs are applied to all pulses.
+        :param path: directory
+        :param pattern: glob pattern of the pulse files
+        :param bandwidth_in_Hz: Bandwidth in Hertz (optional if duration and tbw provided)
+        :param duration_in_us:  Duration in microseconds (optional if bandwidth and tbw provided)
+        :param time_bandwidth: Time Bandwidth product unitless (optional if bandwidth and duration provided)
+        :param max_workers: number of worker processes, defaults to number of cpus
+        :param waveform_dtype: storage dtype of amplitude and phase, "float32" for compact pulses
+        :return: pulses by file name stem
+        """
+        path = plib.Path(path).absolute()
+        if not path.is_dir():
+            err = f"{path} is not a directory"
+            log_module.error(err)
+            raise FileNotFoundError(err)
+        f_names = sorted(path.glob(pattern))
+        log_module.info(f"loading {len(f_names)} pulse files from {path.as_posix()}")
+        pulses = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    cls.load_from_txt, f_name=f_name, bandwidth_in_Hz=bandwidth_in_Hz,
+                    duration_in_us=duration_in_us, time_bandwidth=time_bandwidth, waveform_dtype=waveform_dtype
+                ): f_name for f_name in f_names
+            }
+            for future, f_name in futures.items():
+                pulse = future.result()
+                if not pulse.name:
+                    pulse.name = f_name.stem
+                pulses[f_name.stem] = pulse
+        return pulses
+
     def resample_to_duration(self, duration_in_us: int):
         # want to use pulse with different duration,
         # ! in general time bandwidth properties do not have to go linearly with duration
@@ -203,9 +387,9 @@ class RFPulse(sp.helpers.Serializable):
 
 
 @dc.dataclass
-class RFParameters(sp.helpers.Serializable):
-    excitation: RFPulse = RFPulse()
-    refocusing: RFPulse = RFPulse()
+class RFParameters(sp.helpers.Serializable, BinarySerializable):
+    excitation: RFPulse = sp.field(default_factory=RFPulse)
+    refocusing: RFPulse = sp.field(default_factory=RFPulse)
 
     def display(self):
         log_module.info(f"Excitation Pulse")
@@ -237,12 +421,24 @@ class RFParameters(sp.helpers.Serializable):
     def set_flip_angle(self, flip_angle_rad: float, excitation: bool = True):
         self._get_subclass(excitation=excitation).set_flip_angle(flip_angle_rad=flip_angle_rad)
 
+    def get_flip_angle_train(self, flip_angles_rad: typing.Union[typing.List, np.ndarray],
+                             phases_rad: typing.Union[typing.List, np.ndarray] = None,
+                             excitation: bool = True) -> np.ndarray:
+        """
+        Get the pulse scaled to each of the flip angles, (n_angles, num_samples), complex if phases given.
+        For refocusing trains use eg. PypulseqParameters.refocusing_rf_rad_fa and excitation=False.
+        """
+        return self._get_subclass(excitation=excitation).get_flip_angle_train(
+            flip_angles_rad=flip_angles_rad, phases_rad=phases_rad
+        )
+
     def load_from_txt(self, f_name: typing.Union[str, plib.Path],
                       bandwidth_in_Hz: float = None,
                       duration_in_us: int = None,
                       time_bandwidth: float = None,
                       num_samples: int = None,
-                      excitation: bool = True):
+                      excitation: bool = True,
+                      waveform_dtype: str = "float64"):
         """
         read file from .txt or .pta. Need to fill the additional specs.
         :param f_name: file name
@@ -251,13 +447,14 @@ class RFParameters(sp.helpers.Serializable):
         :param time_bandwidth: Time Bandwidth product unitless (optional if bandwidth and duration provided)
         :param num_samples: number of samples of pulse optional, if None pulse sampled per microsecond
         :param excitation: toggle which of the pulse objects to use
+        :param waveform_dtype: storage dtype of amplitude and phase, "float32" for compact pulses
         :return:
         """
         self._set_subclass(
             rf_pulse=RFPulse.load_from_txt(
                 f_name=f_name,
                 bandwidth_in_Hz=bandwidth_in_Hz, duration_in_us=duration_in_us,
-                time_bandwidth=time_bandwidth, num_samples=num_samples
+                time_bandwidth=time_bandwidth, num_samples=num_samples, waveform_dtype=waveform_dtype
             ),
             excitation=excitation
         )
@@ -0,0 +1,160 @@
+"""
+Lookup index over a final sampling pattern.
+Rows are grouped by (slice_num, echo_num), acq_type and nav_acq via sorted row orders and group offsets,
+hence a query returns a view of a precomputed index array instead of filtering the whole table.
+"""
+import logging
+import typing
+
+import numpy as np
+
+log_module = logging.getLogger(__name__)
+
+
+class SamplingPatternIndex:
+    """
+    Index arrays of a sampling pattern. All row indices refer to the row order of the sampling pattern.
+    """
+    array_keys: typing.Tuple[str, ...] = (
+        "slice_echo_order", "slice_echo_keys", "slice_echo_offsets",
+        "acq_type_order", "acq_type_offsets", "nav_order", "nav_offsets", "scan_row"
+    )
+
+    def __init__(self, arrays: typing.Dict[str, np.ndarray], meta: dict,
+                 scan_num: np.ndarray, pe_num: np.ndarray, acq_type_categories: typing.List[str]):
+        """
+        Use build to create an index from the pattern columns, this constructor attaches stored index arrays.
+        :param arrays: index arrays keyed as in array_keys
+        :param meta: scalar index data, scan_min and whether scan_row is a dense lookup table
+        :param scan_num: scan number column of the pattern
+        :param pe_num: phase encode column of the pattern
+        :param acq_type_categories: categories of the acq_type column, in code order
+        """
+        missing = [key for key in self.array_keys if key not in arrays]
+        if missing:
+            err = f"sampling pattern index arrays missing: {missing}"
+            log_module.error(err)
+            raise ValueError(err)
+        self._arrays: typing.Dict[str, np.ndarray] = {key: arrays[key] for key in self.array_keys}
+        self._scan_min: int = int(meta["scan_min"])
+        self._dense: bool = bool(meta["dense"])
+        self._scan_num: np.ndarray = scan_num
+        self._pe_num: np.ndarray = pe_num
+        if self._arrays["slice_echo_order"].shape[0] != scan_num.shape[0]:
+            err = "sampling pattern index does not match the number of sampling pattern entries"
+            log_module.error(err)
+            raise ValueError(err)
+        keys = self._arrays["slice_echo_keys"].reshape(-1, 2)
+        self._slice_echo: typing.Dict[typing.Tuple[int, int], int] = {
+            (s, e): i for i, (s, e) in enumerate(keys.tolist())
+        }
+        self._acq_type: typing.Dict[str, int] = {c: i for i, c in enumerate(acq_type_categories)}
+        # sorted scan numbers for the binary search if scan numbers are sparse
+        self._sorted_scan_nums: typing.Optional[np.ndarray] = None
+        if not self._dense:
+            self._sorted_scan_nums = scan_num[self._arrays["scan_row"]]
+
+    def __len__(self) -> int:
+        return self._scan_num.shape[0]
+
+    @classmethod
+    def build(cls, scan_num: np.ndarray, slice_num: np.ndarray, echo_num: np.ndarray, pe_num: np.ndarray,
+              acq_type_codes: np.ndarray, acq_type_categories: typing.List[str], nav_acq: np.ndarray):
+        num = scan_num.shape[0]
+        # sorted by slice, echo and scan number
+        order = np.lexsort((scan_num, echo_num, slice_num))
+        s = slice_num[order]
+        e = echo_num[order]
+        starts = np.flatnonzero(np.concatenate(([num > 0], (s[1:] != s[:-1]) | (e[1:] != e[:-1]))))
+        offsets = np.append(starts, num).astype(np.int64)
+        keys = np.stack([s[starts], e[starts]], axis=1).astype(np.int64)
+
+        def grouped(codes: np.ndarray, num_groups: int) -> typing.Tuple[np.ndarray, np.ndarray]:
+            group_order = np.argsort(codes, kind="stable")
+            group_offsets = np.zeros(num_groups + 1, dtype=np.int64)
+            np.cumsum(np.bincount(codes, minlength=num_groups), out=group_offsets[1:])
+            return group_order.astype(np.int64), group_offsets
+
+        acq_order, acq_offsets = grouped(acq_type_codes.astype(np.int64), len(acq_type_categories))
+        nav_order, nav_offsets = grouped(nav_acq.astype(np.int64), 2)
+
+        # direct lookup table of scan number to row, scan numbers are (close to) contiguous
+        scan_min = int(scan_num.min()) if num > 0 else 0
+        span = int(scan_num.max()) - scan_min + 1 if num > 0 else 0
+        if span <= 4 * num + 1024:
+            scan_row = np.full(span, -1, dtype=np.int64)
+            scan_row[scan_num - scan_min] = np.arange(num)
+        else:
+            # sparse scan numbers, rows sorted by scan number for a binary search
+            log_module.debug("sparse scan numbers, sampling pattern index falls back to sorted scan lookup")
+            scan_row = np.argsort(scan_num, kind="stable").astype(np.int64)
+            scan_min = None
+        arrays = {
+            "slice_echo_order": order.astype(np.int64), "slice_echo_keys": keys, "slice_echo_offsets": offsets,
+            "acq_type_order": acq_order, "acq_type_offsets": acq_offsets,
+            "nav_order": nav_order, "nav_offsets": nav_offsets, "scan_row": scan_row
+        }
+        meta = {"scan_min": scan_min if scan_min is not None else -1, "dense": scan_min is not None}
+        return cls(arrays=arrays, meta=meta, scan_num=scan_num, pe_num=pe_num, acq_type_categories=acq_type_categories)
+
+    def to_arrays(self) -> typing.Tuple[typing.Dict[str, np.ndarray], dict]:
+        return dict(self._arrays), {"scan_min": self._scan_min, "dense": self._dense}
+
+    @staticmethod
+    def _group(order: np.ndarray, offsets: np.ndarray, idx: typing.Optional[int]) -> np.ndarray:
+        if idx is None:
+            return order[:0]
+        rows = order[offsets[idx]:offsets[idx + 1]]
+        rows.flags.writeable = False
+        return rows
+
+    @property
+    def slice_echo_keys(self) -> typing.List[typing.Tuple[int, int]]:
+        return list(self._slice_echo.keys())
+
+    def rows(self, slice_num: int, echo_num: int) -> np.ndarray:
+        """
+        Rows of all entries of a slice and echo, sorted by scan number. Empty if there are none.
+        """
+        return self._group(
+            self._arrays["slice_echo_order"], self._arrays["slice_echo_offsets"],
+            self._slice_echo.get((int(slice_num), int(echo_num)))
+        )
+
+    def scan_nums(self, slice_num: int, echo_num: int) -> np.ndarray:
+        """
+        Sorted scan numbers of all entries of a slice and echo.
+        """
+        return self._scan_num[self.rows(slice_num, echo_num)]
+
+    def acq_type_rows(self, acq_type: str) -> np.ndarray:
+        return self._group(
+            self._arrays["acq_type_order"], self._arrays["acq_type_offsets"], self._acq_type.get(acq_type)
+        )
+
+    def nav_rows(self, nav_acq: bool = True) -> np.ndarray:
+        return self._group(self._arrays["nav_order"], self._arrays["nav_offsets"], int(bool(nav_acq)))
+
+    def row_of_scan(self, scan_num: int) -> int:
+        """
+        Row of a scan number, raises KeyError if the scan is not part of the pattern.
+        """
+        scan_num = int(scan_num)
+        scan_row = self._arrays["scan_row"]
+        row = -1
+        if self._dense:
+            idx = scan_num - self._scan_min
+            if 0 <= idx < scan_row.shape[0]:
+                row = int(scan_row[idx])
+        else:
+            idx = int(np.searchsorted(self._sorted_scan_nums, scan_num))
+            if idx < scan_row.shape[0] and self._sorted_scan_nums[idx] == scan_num:
+                row = int(scan_row[idx])
+        if row < 0:
+            err = f"scan number {scan_num} not in sampling pattern"
+            log_module.error(err)
+            raise KeyError(err)
+        return row
+
+    def pe_num_of_scan(self, scan_num: int) -> int:
+        return int(self._pe_num[self.row_of_scan(scan_num)])
@@ -1,75 +1,226 @@
 import typing
 import simple_parsing as sp
 import numpy as np
-import pandas as pd
 import logging
 import pathlib as plib
 import dataclasses as dc
-import plotly.express as px
+import functools
+import hashlib
+import json
+import os
+from ..lazy_import import lazy_import
+from .binary import BinarySerializable
+from .storage import SamplingPatternBuffer, KTrajectoryStore, StorageField
+from .sampling_stream import SamplingPatternStreamWriter
+from .sampling_index import SamplingPatternIndex
+
+# pandas and plotly are only imported when the tables are read or plotted
+pd = lazy_import("pandas")
+px = lazy_import("plotly.express")
+go = lazy_import("plotly.graph_objects")
 
 log_module = logging.getLogger(__name__)
 
 
 @dc.dataclass
-class SamplingKTrajectoryParameters(sp.helpers.Serializable):
-    k_trajectories: pd.DataFrame = pd.DataFrame(
-        columns=["acquisition", "adc_sampling_num", "k_traj_position"]
-    )
-    sampling_pattern: pd.DataFrame = pd.DataFrame(
-        columns=["scan_num", "slice_num", "pe_num", "acq_type",
-                 "echo_num", "echo_type", "echo_type_num",
-                 "nav_acq"]
-    )
+class SamplingKTrajectoryParameters(sp.helpers.Serializable, BinarySerializable):
+    # ragged array storage, the DataFrame is built when read, it is a copy
+    k_trajectories: "pd.DataFrame" = StorageField(KTrajectoryStore)
+    # backed by a columnar buffer, the DataFrame (indexed by scan number) is built when read,
+    # it is a copy: set edited frames back to store the edits
+    sampling_pattern: "pd.DataFrame" = StorageField(SamplingPatternBuffer)
 
     def register_trajectory(self, trajectory: np.ndarray, identifier: str):
-        if trajectory.shape.__len__() > 1:
-            adc_samples = trajectory[:, 0]
-            k_read_pos = trajectory[:, 1]
-        else:
-            adc_samples = np.arange(trajectory.shape[0])
-            k_read_pos = trajectory
-        acquisition = [identifier] * trajectory.shape[0]
+        self.get_k_trajectory_store().register(identifier=identifier, trajectory=trajectory)
+
+    def register_trajectories(self, trajectories: typing.Dict[str, np.ndarray]):
+        """
+        Register many trajectories in one go.
+        :param trajectories: mapping of acquisition identifier to trajectory,
+            either 1D k-space positions or 2D with columns (adc sampling number, k-space position)
+        """
+        self.get_k_trajectory_store().register_many(trajectories)
 
-        df = pd.DataFrame({
-            "acquisition": acquisition, "adc_sampling_num": adc_samples, "k_traj_position": k_read_pos
-        })
-        self.k_trajectories = pd.concat((self.k_trajectories, df)).reset_index(drop=True)
+    def get_trajectory(self, identifier: str) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Get (adc sampling numbers, k-space positions) of an acquisition as read only views, no copy is made.
+        """
+        return self.get_k_trajectory_store().get(identifier)
+
+    def get_k_trajectory_store(self) -> KTrajectoryStore:
+        return StorageField.storage_of(self, "k_trajectories")
 
     def write_sampling_pattern_entry(
             self, scan_num: int, slice_num: int, pe_num, echo_num: int,
             acq_type: str = "", echo_type: str = "", echo_type_num: int = -1,
             nav_acq: bool = False, nav_dir: int = 0):
-        # check if entry exists already
-        if scan_num in self.sampling_pattern["scan_num"]:
-            err = f"scan number to register in sampling pattern ({scan_num}) exists already!"
-            log_module.error(err)
-            raise ValueError(err)
-        # build entry
-        new_row = pd.Series({
-            "scan_num": scan_num, "slice_num": slice_num, "pe_num": pe_num, "acq_type": acq_type,
-            "echo_num": echo_num, "echo_type": echo_type, "echo_type_num": echo_type_num,
-            "nav_acq": nav_acq
-        })
-        # add entry
-        self.sampling_pattern = pd.concat((self.sampling_pattern, new_row.to_frame().T))
+        # add entry, raises if the scan number exists already
+        self.get_sampling_pattern_buffer().append(
+            scan_num=scan_num, slice_num=slice_num, pe_num=pe_num, echo_num=echo_num,
+            acq_type=acq_type, echo_type=echo_type, echo_type_num=echo_type_num, nav_acq=nav_acq
+        )
 
     def sampling_pattern_from_list(self, sp_list: list):
-        self.sampling_pattern = pd.DataFrame(sp_list).set_index("scan_num")
+        buffer = SamplingPatternBuffer(capacity=len(sp_list))
+        buffer.extend(sp_list)
+        self.sampling_pattern = buffer
+
+    def get_sampling_pattern_buffer(self) -> SamplingPatternBuffer:
+        return StorageField.storage_of(self, "sampling_pattern")
+
+    def get_sampling_pattern_index(self) -> SamplingPatternIndex:
+        """
+        Lookup index over the sampling pattern (scans per slice and echo, acquisition type, navigators),
+        built once the pattern is final and stored with it.
+        """
+        return self.get_sampling_pattern_buffer().get_index()
+
+    def get_k_space_coordinates(
+            self, delta_k_phase: float, delta_k_slice: float = None, rows: np.ndarray = None,
+            acq_type_map: typing.Dict[str, str] = None, pe_center: int = 0, slice_center: int = 0,
+            dtype=np.float32, cache_dir: typing.Union[str, plib.Path] = None,
+            block_size: int = 65536) -> np.ndarray:
+        """
+        Build the k-space coordinates of all acquisitions at once, eg. for NUFFT gridding.
+        Read positions are the trajectory registered for the acquisition type of each sampling pattern entry,
+        placed at their adc sampling number, phase (and slice) positions are pe_num - pe_center
+        (slice_num - slice_center) times the k-space step.
+        :param delta_k_phase: k-space step in phase direction
+        :param delta_k_slice: k-space step in slice direction, adds a third coordinate (3D encoding)
+        :param rows: sampling pattern rows to export, eg. from the sampling pattern index, default all
+        :param acq_type_map: trajectory identifier per acquisition type, by default identifiers equal the types,
+            if only one trajectory is registered it is used for all types without one
+        :param pe_center: phase encode number of the k-space center
+        :param slice_center: slice number of the k-space center
+        :param dtype: dtype of the coordinates
+        :param cache_dir: store the result as .npy keyed by a hash of all inputs and memory-map it read only,
+            later calls with equal inputs map the stored file
+        :param block_size: number of rows processed at once, bounds temporary memory
+        :return: coordinates (number of rows, max adc sampling number + 1, 2 or 3) ordered (read, phase[, slice]),
+            adc samples without trajectory position (past the end of shorter trajectories) are nan
+        """
+        buffer = self.get_sampling_pattern_buffer()
+        if rows is None:
+            rows = np.arange(len(buffer))
+        rows = np.asarray(rows, dtype=np.int64)
+        acq_codes = buffer.codes("acq_type")[rows]
+        pe_num = buffer.codes("pe_num")[rows]
+        slice_num = buffer.codes("slice_num")[rows]
+        categories = buffer.categories("acq_type").tolist()
+        if acq_type_map is None:
+            acq_type_map = {}
+        used_codes = np.unique(acq_codes)
+        identifiers = [acq_type_map.get(categories[c], categories[c]) for c in used_codes.tolist()]
+        store = self.get_k_trajectory_store()
+        missing = [i for i in identifiers if i not in store]
+        if missing:
+            if len(store) == 1:
+                # unambiguous, eg. entries written without acquisition type
+                log_module.info(f"no trajectory registered for {missing}, using the only one: {store.identifiers[0]}")
+                identifiers = [i if i in store else store.identifiers[0] for i in identifiers]
+            else:
+                err = (f"no k-space trajectory registered for acquisition type(s) {missing}, registered are "
+                       f"{store.identifiers}. Map acquisition types to trajectories via acq_type_map")
+                log_module.error(err)
+                raise ValueError(err)
+
+        cache_file = None
+        if cache_dir is not None:
+            key = hashlib.sha256()
+            for arr in (acq_codes, pe_num, slice_num):
+                key.update(np.ascontiguousarray(arr).data)
+            for identifier in identifiers:
+                key.update(identifier.encode("utf-8"))
+                for arr in store.get(identifier):
+                    key.update(np.ascontiguousarray(arr).data)
+            key.update(json.dumps(
+                [delta_k_phase, delta_k_slice, pe_center, slice_center, np.dtype(dtype).str]
+            ).encode("utf-8"))
+            cache_file = plib.Path(cache_dir).absolute().joinpath(f"k_coordinates_{key.hexdigest()[:32]}.npy")
+            if cache_file.is_file():
+                log_module.debug(f"load cached k-space coordinates: {cache_file.as_posix()}")
+                return np.load(cache_file, mmap_mode="r")
+
+        # one padded read trajectory per used acquisition type
+        read, _ = store.padded(identifiers, by_adc_sample=True)
+        read_pad = np.where(np.isnan(read), np.nan, 0.0)
+        type_idx = np.searchsorted(used_codes, acq_codes)
+        num_dims = 2 if delta_k_slice is None else 3
+        shape = (rows.shape[0], read.shape[1], num_dims)
+        if cache_file is not None:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_name(f"{cache_file.stem}.{os.getpid()}.tmp")
+            coords = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=dtype, shape=shape)
+        else:
+            coords = np.empty(shape, dtype=dtype)
+        for start in range(0, rows.shape[0], block_size):
+            sl = slice(start, start + block_size)
+            t_idx = type_idx[sl]
+            coords[sl, :, 0] = read[t_idx]
+            coords[sl, :, 1] = ((pe_num[sl] - pe_center) * delta_k_phase)[:, None] + read_pad[t_idx]
+            if delta_k_slice is not None:
+                coords[sl, :, 2] = ((slice_num[sl] - slice_center) * delta_k_slice)[:, None] + read_pad[t_idx]
+        if cache_file is not None:
+            coords.flush()
+            del coords
+            os.replace(tmp_file, cache_file)
+            log_module.info(f"cached k-space coordinates: {cache_file.as_posix()}")
+            return np.load(cache_file, mmap_mode="r")
+        return coords
+
+    def stream_sampling_pattern(self, path: typing.Union[str, plib.Path], chunk_size: int = 65536,
+                                fsync: bool = False):
+        """
+        Spill sampling pattern entries to an append only file while the sequence is built.
+        At most chunk_size entries are held in memory, the file can be read with
+        SamplingPatternStreamReader while entries are still written.
+        :param path: stream file path, overwritten if existing
+        :param chunk_size: number of entries per chunk
+        :param fsync: force every chunk to disk
+        """
+        log_module.info(f"stream sampling pattern to: {plib.Path(path).as_posix()}")
+        writer = SamplingPatternStreamWriter(path, fsync=fsync)
+        self.get_sampling_pattern_buffer().spill_to(writer, chunk_size=chunk_size)
 
-    def plot_sampling_pattern(self, output_path: typing.Union[str, plib.Path]):
+    def finish_sampling_pattern_stream(self, load: bool = True):
+        """
+        Write the remaining entries and close the stream.
+        :param load: read the full sampling pattern back into memory, otherwise it is left in the file only
+        """
+        self.get_sampling_pattern_buffer().close_spill(load=load)
+
+    def plot_sampling_pattern(self, output_path: typing.Union[str, plib.Path], max_points: int = 100000,
+                              binned: bool = False, max_file_size_mb: float = 50.0):
+        """
+        Plot the sampling pattern. Patterns with more than max_points entries are decimated per
+        (echo, navigator) group or, if binned, aggregated into 2D bins, and drawn with WebGL traces.
+        :param output_path: plots are written to <output_path>/plots
+        :param max_points: maximum number of points drawn
+        :param binned: aggregate large patterns into (scan, phase encode) bins instead of decimating
+        :param max_file_size_mb: the number of points is reduced until the figure fits this size
+        """
         # ensure plib path
         out_path = plib.Path(output_path).absolute().joinpath("plots")
         out_path.mkdir(parents=True, exist_ok=True)
+        buffer = self.get_sampling_pattern_buffer()
         # plot
-        fig_multi_acq = px.scatter(
-            self.sampling_pattern, x=self.sampling_pattern.index, y="pe_num",
-            color="echo_num", symbol="echo_type",
-            size="slice_num",
-            labels={
-                "index": "Scan Number", "pe_num": "# phase encode", "echo_type": "echo-type",
-                "slice_num": "# slice"
-            }
-        )
+        if len(buffer) <= max_points and not binned:
+            df = self.sampling_pattern
+            fig_multi_acq = px.scatter(
+                df, x=df.index, y="pe_num",
+                color="echo_num", symbol="echo_type",
+                size="slice_num",
+                labels={
+                    "scan_num": "Scan Number", "pe_num": "# phase encode", "echo_type": "echo-type",
+                    "slice_num": "# slice"
+                },
+                render_mode="webgl"
+            )
+        else:
+            fig_multi_acq = _capped_figure(
+                functools.partial(_sampling_pattern_figure, buffer, binned=binned),
+                max_points=max_points, max_file_size_mb=max_file_size_mb
+            )
 
         fig_multi_acq.update_layout(
             title="Sampling Pattern Sequence",
@@ -81,13 +232,136 @@ class SamplingKTrajectoryParameters(sp.helpers.Serializable):
         log_module.info(f"\t- writing plot file: {save_file}")
         fig_multi_acq.write_html(save_file)
 
-    def plot_k_space_trajectories(self, output_path: typing.Union[str, plib.Path]):
+    def plot_k_space_trajectories(self, output_path: typing.Union[str, plib.Path], max_points: int = 100000,
+                                  max_file_size_mb: float = 50.0):
+        """
+        Plot the registered trajectories, with more than max_points samples each trajectory is decimated.
+        """
         # ensure plib path
         out_path = plib.Path(output_path).absolute().joinpath("plots")
         out_path.mkdir(parents=True, exist_ok=True)
+        store = self.get_k_trajectory_store()
         # plot
-        fig = px.scatter(self.k_trajectories, x="adc_sampling_num", y="k_traj_position", color="acquisition")
+        if store.num_samples <= max_points:
+            fig = px.scatter(
+                self.k_trajectories, x="adc_sampling_num", y="k_traj_position", color="acquisition",
+                render_mode="webgl"
+            )
+        else:
+            fig = _capped_figure(
+                functools.partial(_k_trajectory_figure, store),
+                max_points=max_points, max_file_size_mb=max_file_size_mb
+            )
         # save
         f_name = out_path.joinpath("k_space_trajectories").with_suffix(".html")
         log_module.info(f"\t\t - writing file: {f_name.as_posix()}")
         fig.write_html(f_name.as_posix())
+
+
+def _decimate(groups: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Rows kept when reducing to about max_points, every group keeps a share proportional to its size
+    but at least a few rows, hence small groups (eg. navigators) stay visible.
+    """
+    num = groups.shape[0]
+    if num <= max_points:
+        return np.arange(num)
+    order = np.argsort(groups, kind="stable")
+    uniques, starts, counts = np.unique(groups[order], return_index=True, return_counts=True)
+    quota = np.maximum(np.ceil(counts * max_points / num), np.minimum(counts, 100)).astype(np.int64)
+    stride = np.maximum(counts // quota, 1)
+    # position within group, keep every stride-th row
+    pos = np.arange(num) - np.repeat(starts, counts)
+    keep = pos % np.repeat(stride, counts) == 0
+    return np.sort(order[keep])
+
+
+def _sampling_pattern_figure(buffer: SamplingPatternBuffer, max_points: int, binned: bool = False):
+    if len(buffer) == 0:
+        return go.Figure()
+    scan_num = buffer.codes("scan_num")
+    pe_num = buffer.codes("pe_num")
+    echo_num = buffer.codes("echo_num")
+    slice_num = buffer.codes("slice_num")
+    nav_acq = buffer.codes("nav_acq")
+    fig = go.Figure()
+    if binned:
+        # mean echo number per (scan, phase encode) bin of imaging acquisitions, navigators drawn on top
+        img = ~nav_acq
+        num_bins_scan = int(max(min(max_points // max(np.unique(pe_num[img]).shape[0], 1), 2000), 1))
+        pe_edges = np.arange(pe_num.min(), pe_num.max() + 2) - 0.5
+        scan_edges = np.linspace(scan_num.min(), scan_num.max() + 1, num_bins_scan + 1)
+        counts, _, _ = np.histogram2d(scan_num[img], pe_num[img], bins=(scan_edges, pe_edges))
+        sums = []
+        for values in (echo_num, slice_num):
+            w, _, _ = np.histogram2d(scan_num[img], pe_num[img], bins=(scan_edges, pe_edges), weights=values[img])
+            with np.errstate(invalid="ignore", divide="ignore"):
+                sums.append(w / counts)
+        fig.add_trace(go.Heatmap(
+            x=0.5 * (scan_edges[1:] + scan_edges[:-1]), y=0.5 * (pe_edges[1:] + pe_edges[:-1]),
+            z=sums[0].T, customdata=np.stack([sums[1].T, counts.T], axis=-1),
+            colorscale="Viridis", colorbar=dict(title="mean echo"), name="imaging",
+            hovertemplate="scan %{x:.0f}<br>pe %{y}<br>mean echo %{z:.2f}<br>mean slice %{customdata[0]:.2f}"
+                          "<br>entries %{customdata[1]}<extra></extra>"
+        ))
+        rows = np.flatnonzero(nav_acq)
+        rows = rows[_decimate(np.zeros(rows.shape[0], dtype=np.int64), max_points // 10)]
+        traces = [("navigator", rows)]
+    else:
+        rows = _decimate(echo_num * 2 + nav_acq, max_points)
+        traces = []
+        for echo in np.unique(echo_num[rows]).tolist():
+            for nav in (False, True):
+                sel = rows[(echo_num[rows] == echo) & (nav_acq[rows] == nav)]
+                if sel.shape[0] > 0:
+                    traces.append((f"echo {echo}" + (" nav" if nav else ""), sel))
+    for name, sel in traces:
+        fig.add_trace(go.Scattergl(
+            x=scan_num[sel], y=pe_num[sel], mode="markers", name=name,
+            marker=dict(size=4 + 6 * slice_num[sel] / max(int(slice_num.max()), 1),
+                        symbol="x" if name.endswith("nav") or name == "navigator" else "circle"),
+            customdata=slice_num[sel],
+            hovertemplate="scan %{x}<br>pe %{y}<br>slice %{customdata}<extra>%{fullData.name}</extra>"
+        ))
+    return fig
+
+
+def _k_trajectory_figure(store: KTrajectoryStore, max_points: int):
+    # all acquisitions in one trace separated by NaN, the size of the figure is bound by max_points
+    # regardless of the number of identifiers, which are subsampled if there are more than max_points / 2
+    identifiers = store.identifiers
+    num_ids = max(min(len(identifiers), max_points // 2), 1)
+    picked = np.unique(np.linspace(0, len(identifiers) - 1, num_ids).round().astype(int)) if identifiers else []
+    per_acq = max(max_points // num_ids, 2)
+    xs, ys, ids = [], [], []
+    for i in picked:
+        adc_samples, k_pos = store.get(identifiers[i])
+        step = max(int(np.ceil(adc_samples.shape[0] / per_acq)), 1)
+        xs.extend([adc_samples[::step].astype(np.float64), [np.nan]])
+        ys.extend([k_pos[::step].astype(np.float64), [np.nan]])
+        ids.append(np.full(xs[-2].shape[0] + 1, i))
+    if len(picked) < len(identifiers):
+        log_module.info(f"plotting {len(picked)} of {len(identifiers)} k-space trajectories")
+    fig = go.Figure()
+    fig.add_trace(go.Scattergl(
+        x=np.concatenate(xs) if xs else [], y=np.concatenate(ys) if ys else [], mode="markers",
+        marker=dict(color=np.concatenate(ids) if ids else [], colorscale="Viridis", size=4),
+        customdata=[identifiers[i] for i in np.concatenate(ids)] if ids else [],
+        hovertemplate="%{customdata}<br>adc %{x}<br>k %{y}<extra></extra>", name="k-trajectories"
+    ))
+    fig.update_layout(xaxis_title="adc_sampling_num", yaxis_title="k_traj_position")
+    return fig
+
+
+def _capped_figure(build: typing.Callable, max_points: int, max_file_size_mb: float):
+    # halve the number of points until the serialized figure fits, plotly.js itself adds ~4 MB to the html
+    while True:
+        fig = build(max_points=max_points)
+        size_mb = len(fig.to_json()) / 1024 ** 2 + 4.0
+        if size_mb <= max_file_size_mb or max_points <= 1000:
+            break
+        log_module.debug(f"plot size {size_mb:.1f} MB above cap, reduce to {max_points // 2} points")
+        max_points //= 2
+    if size_mb > max_file_size_mb:
+        log_module.warning(f"plot size {size_mb:.1f} MB above cap of {max_file_size_mb:.1f} MB")
+    return fig
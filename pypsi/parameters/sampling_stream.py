@@ -0,0 +1,160 @@
+"""
+Append only, chunked on-disk stream of sampling pattern entries.
+During sequence build entries are spilled chunk wise to the file, hence memory stays bounded and
+everything written so far survives a crash. Readers can consume complete chunks while the writer is active.
+
+Layout: file magic (8 bytes) | record | record | ...
+record: magic (4 bytes) | meta length (uint32) | payload length (uint64) | JSON meta | column data
+"""
+import json
+import logging
+import os
+import pathlib as plib
+import struct
+import typing
+
+import numpy as np
+
+from .storage import SamplingPatternBuffer
+
+log_module = logging.getLogger(__name__)
+
+STREAM_MAGIC: bytes = b"PYPSISP1"
+RECORD_MAGIC: bytes = b"PSPC"
+_RECORD = struct.Struct("<4sIQ")
+
+
+class SamplingPatternStreamWriter:
+    def __init__(self, path: typing.Union[str, plib.Path], fsync: bool = False):
+        """
+        Create a new stream file.
+        :param path: file path, an existing file is overwritten
+        :param fsync: force each chunk to disk, not only to the os
+        """
+        self.path: plib.Path = plib.Path(path).absolute()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fsync: bool = fsync
+        self.num_rows: int = 0
+        self.num_chunks: int = 0
+        self._file = open(self.path, "wb")
+        self._file.write(STREAM_MAGIC)
+        self._file.flush()
+
+    def write_chunk(self, arrays: typing.Dict[str, np.ndarray], meta: dict):
+        """
+        Append one chunk, see SamplingPatternBuffer.flush.
+        :param arrays: column arrays, string columns as codes
+        :param meta: categories of the string columns
+        """
+        if self._file is None:
+            err = f"sampling pattern stream {self.path} closed"
+            log_module.error(err)
+            raise ValueError(err)
+        num = arrays["scan_num"].shape[0]
+        if num == 0:
+            return
+        arrays = {col: np.ascontiguousarray(arr) for col, arr in arrays.items()}
+        meta = dict(meta, num=num, columns={col: arr.dtype.str for col, arr in arrays.items()})
+        meta = json.dumps(meta).encode("utf-8")
+        payload_len = sum(arr.nbytes for arr in arrays.values())
+        self._file.write(_RECORD.pack(RECORD_MAGIC, len(meta), payload_len))
+        self._file.write(meta)
+        for arr in arrays.values():
+            self._file.write(arr.data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.num_rows += num
+        self.num_chunks += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class SamplingPatternStreamReader:
+    """
+    Reads complete chunks of a sampling pattern stream, also while it is still written.
+    Incomplete trailing records (writer active or crashed) are left for the next read.
+    """
+    def __init__(self, path: typing.Union[str, plib.Path]):
+        self.path: plib.Path = plib.Path(path).absolute()
+        with open(self.path, "rb") as f:
+            if f.read(len(STREAM_MAGIC)) != STREAM_MAGIC:
+                err = f"{self.path} is not a sampling pattern stream"
+                log_module.error(err)
+                raise ValueError(err)
+        self._offset: int = len(STREAM_MAGIC)
+
+    def _read_chunks(self, offset: int, max_chunks: int = None) \
+            -> typing.Tuple[typing.List[typing.Tuple[dict, dict]], int]:
+        chunks = []
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while max_chunks is None or len(chunks) < max_chunks:
+                head = f.read(_RECORD.size)
+                if len(head) < _RECORD.size:
+                    break
+                magic, meta_len, payload_len = _RECORD.unpack(head)
+                if magic != RECORD_MAGIC:
+                    err = f"corrupt record in sampling pattern stream {self.path} at byte {offset}"
+                    log_module.error(err)
+                    raise ValueError(err)
+                meta = f.read(meta_len)
+                payload = f.read(payload_len)
+                if len(meta) < meta_len or len(payload) < payload_len:
+                    # record not complete yet
+                    break
+                meta = json.loads(meta.decode("utf-8"))
+                arrays = {}
+                start = 0
+                for col, dtype in meta["columns"].items():
+                    dtype = np.dtype(dtype)
+                    nbytes = meta["num"] * dtype.itemsize
+                    arrays[col] = np.frombuffer(payload, dtype=dtype, count=meta["num"], offset=start)
+                    start += nbytes
+                chunks.append((arrays, meta))
+                offset = f.tell()
+        return chunks, offset
+
+    @staticmethod
+    def _combine(chunks: typing.List[typing.Tuple[dict, dict]]) -> SamplingPatternBuffer:
+        if not chunks:
+            return SamplingPatternBuffer()
+        arrays = {
+            col: np.concatenate([c[0][col] for c in chunks]) for col in SamplingPatternBuffer.columns
+        }
+        # category lists only grow, the last chunk holds all of them
+        return SamplingPatternBuffer.from_arrays(arrays, meta=chunks[-1][1])
+
+    def iter_chunks(self) -> typing.Iterator[SamplingPatternBuffer]:
+        """
+        Iterate over all complete chunks from the start of the stream, one chunk in memory at a time.
+        """
+        offset = len(STREAM_MAGIC)
+        while True:
+            chunks, offset = self._read_chunks(offset, max_chunks=1)
+            if not chunks:
+                return
+            yield self._combine(chunks)
+
+    def read_new(self) -> SamplingPatternBuffer:
+        """
+        Read all chunks completed since the last call of read_new.
+        """
+        chunks, self._offset = self._read_chunks(self._offset)
+        return self._combine(chunks)
+
+    def read_all(self) -> SamplingPatternBuffer:
+        """
+        Read all complete chunks into one buffer.
+        """
+        chunks, _ = self._read_chunks(len(STREAM_MAGIC))
+        return self._combine(chunks)
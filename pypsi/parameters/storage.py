@@ -0,0 +1,819 @@
+"""
+Array backed storage for the tabular members of the parameter classes.
+The pandas DataFrames the interface exposes are only built when they are read,
+while appending and bookkeeping work on typed numpy arrays.
+"""
+import logging
+import pathlib as plib
+import typing
+
+import numpy as np
+
+from ..lazy_import import lazy_import
+from .sampling_index import SamplingPatternIndex
+
+pd = lazy_import("pandas")
+
+log_module = logging.getLogger(__name__)
+
+
+def _detached(df: "pd.DataFrame") -> "pd.DataFrame":
+    # hand out a frame whose edits do not reach the cached one,
+    # with copy on write (default from pandas 3) a shallow copy suffices
+    copy_on_write = int(pd.__version__.split(".")[0]) >= 3 or pd.get_option("mode.copy_on_write") is True
+    return df.copy(deep=not copy_on_write)
+
+
+class ScanNumberSet:
+    """
+    Set of the registered scan numbers for the duplicate check of the sampling pattern.
+    Numbers are held in sorted int64 runs (8 bytes per scan instead of the ~70 of a python set),
+    single additions collect in a small pending set first. Runs are merged geometrically, hence there are
+    O(log n) runs. Once spilling, large runs are moved to memory-mapped files next to the stream.
+    """
+    pending_size: int = 4096
+    spill_rows: int = 1 << 16
+
+    def __init__(self):
+        self._runs: typing.List[np.ndarray] = []
+        self._run_files: typing.List[typing.Optional[plib.Path]] = []
+        self._pending: typing.Set[int] = set()
+        # largest number held in the runs, appended scan numbers are usually increasing
+        self._max: int = -1
+        self._spill_prefix: typing.Optional[plib.Path] = None
+        self._num_files: int = 0
+
+    @classmethod
+    def from_values(cls, values: np.ndarray) -> "ScanNumberSet":
+        instance = cls()
+        instance.update(values)
+        return instance
+
+    def __len__(self) -> int:
+        return sum(run.shape[0] for run in self._runs) + len(self._pending)
+
+    def __contains__(self, value: int) -> bool:
+        if value in self._pending:
+            return True
+        if not self._runs or value > self._max:
+            return False
+        for run in self._runs:
+            idx = np.searchsorted(run, value)
+            if idx < run.shape[0] and run[idx] == value:
+                return True
+        return False
+
+    def duplicates(self, values: np.ndarray) -> np.ndarray:
+        """
+        Values contained in the set already.
+        """
+        values = np.asarray(values, dtype=np.int64).reshape(-1)
+        found = np.zeros(values.shape[0], dtype=bool)
+        if self._pending:
+            found |= np.isin(values, np.fromiter(self._pending, dtype=np.int64, count=len(self._pending)))
+        candidates = values <= self._max
+        if np.any(candidates):
+            check = values[candidates]
+            hit = np.zeros(check.shape[0], dtype=bool)
+            for run in self._runs:
+                idx = np.minimum(np.searchsorted(run, check), run.shape[0] - 1)
+                hit |= run[idx] == check
+            found[candidates] |= hit
+        return values[found]
+
+    def add(self, value: int):
+        self._pending.add(value)
+        if len(self._pending) >= self.pending_size:
+            self._push(np.sort(np.fromiter(self._pending, dtype=np.int64, count=len(self._pending))))
+            self._pending = set()
+
+    def update(self, values: np.ndarray):
+        """
+        Add new values, the caller checked for duplicates.
+        """
+        values = np.asarray(values, dtype=np.int64).reshape(-1)
+        if values.shape[0] > 0:
+            self._push(np.sort(values))
+
+    def _push(self, run: np.ndarray):
+        self._runs.append(run)
+        self._run_files.append(None)
+        self._max = max(self._max, int(run[-1]))
+        # merge while the previous run is not much larger, keeps the run sizes geometrically decreasing
+        while len(self._runs) > 1 and self._runs[-2].shape[0] <= 2 * self._runs[-1].shape[0]:
+            last, previous = self._runs.pop(), self._runs.pop()
+            for f in (self._run_files.pop(), self._run_files.pop()):
+                if f is not None:
+                    f.unlink(missing_ok=True)
+            merged = np.concatenate((previous, last))
+            merged.sort(kind="stable")
+            self._runs.append(merged)
+            self._run_files.append(None)
+        self._maybe_spill(len(self._runs) - 1)
+
+    def _maybe_spill(self, idx: int):
+        if self._spill_prefix is None or self._run_files[idx] is not None:
+            return
+        run = self._runs[idx]
+        if run.shape[0] < self.spill_rows:
+            return
+        f = self._spill_prefix.with_name(f"{self._spill_prefix.name}.scan_nums.{self._num_files}.npy")
+        self._num_files += 1
+        np.save(f, run)
+        self._runs[idx] = np.load(f, mmap_mode="r")
+        self._run_files[idx] = f
+
+    def spill_to(self, prefix: typing.Union[str, plib.Path]):
+        """
+        Keep large runs in memory-mapped files named after prefix.
+        """
+        self._spill_prefix = plib.Path(prefix)
+        for idx in range(len(self._runs)):
+            self._maybe_spill(idx)
+
+    def close_spill(self):
+        """
+        Read spilled runs back into memory and remove their files.
+        """
+        for idx, f in enumerate(self._run_files):
+            if f is not None:
+                self._runs[idx] = np.array(self._runs[idx])
+                f.unlink(missing_ok=True)
+                self._run_files[idx] = None
+        self._spill_prefix = None
+
+
+class SamplingPatternBuffer:
+    """
+    Growable columnar store for sampling pattern entries.
+    Every column is a typed numpy array with geometric growth, hence appending is amortized O(1).
+    String columns are kept as integer codes into a per column category list.
+    """
+    columns: typing.Tuple[str, ...] = (
+        "scan_num", "slice_num", "pe_num", "acq_type",
+        "echo_num", "echo_type", "echo_type_num", "nav_acq"
+    )
+    int_columns: typing.Tuple[str, ...] = ("scan_num", "slice_num", "pe_num", "echo_num", "echo_type_num")
+    str_columns: typing.Tuple[str, ...] = ("acq_type", "echo_type")
+    bool_columns: typing.Tuple[str, ...] = ("nav_acq",)
+    defaults: typing.Dict[str, typing.Any] = {
+        "acq_type": "", "echo_type": "", "echo_type_num": -1, "nav_acq": False
+    }
+
+    def __init__(self, capacity: int = 1024):
+        self._size: int = 0
+        self._capacity: int = max(int(capacity), 1)
+        self._data: typing.Dict[str, np.ndarray] = {}
+        for col in self.columns:
+            self._data[col] = np.empty(self._capacity, dtype=self._column_dtype(col))
+        self._categories: typing.Dict[str, typing.List[str]] = {col: [] for col in self.str_columns}
+        self._category_codes: typing.Dict[str, typing.Dict[str, int]] = {col: {} for col in self.str_columns}
+        # registered scan numbers, built on demand when loaded from arrays
+        self._scan_nums: typing.Optional[ScanNumberSet] = ScanNumberSet()
+        self._df_cache: typing.Optional["pd.DataFrame"] = None
+        self._index: typing.Optional[SamplingPatternIndex] = None
+        # incremented on every change, derived data is cached per version
+        self._version: int = 0
+        # optional stream writer the rows are spilled to in chunks
+        self._spill = None
+        self._spill_chunk_size: int = 0
+        self._num_spilled: int = 0
+        # all rows while spilling, read back from the stream incrementally, valid for _resolved_version
+        self._resolved_cache: typing.Optional["SamplingPatternBuffer"] = None
+        self._resolved_reader = None
+        self._resolved_version: int = -1
+
+    def __len__(self) -> int:
+        return self._num_spilled + self._size
+
+    def __contains__(self, scan_num) -> bool:
+        return int(scan_num) in self._get_scan_nums()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def is_spilling(self) -> bool:
+        return self._spill is not None
+
+    def _get_scan_nums(self) -> ScanNumberSet:
+        if self._scan_nums is None:
+            self._scan_nums = ScanNumberSet.from_values(self._data["scan_num"][:self._size])
+        return self._scan_nums
+
+    def _column_dtype(self, col: str):
+        if col in self.int_columns:
+            return np.int64
+        if col in self.str_columns:
+            return np.int32
+        return np.bool_
+
+    def _reserve(self, num: int):
+        if self._size + num <= self._capacity:
+            return
+        capacity = max(2 * self._capacity, self._size + num)
+        for col in self.columns:
+            data = np.empty(capacity, dtype=self._column_dtype(col))
+            data[:self._size] = self._data[col][:self._size]
+            self._data[col] = data
+        self._capacity = capacity
+
+    def _encode(self, col: str, value: str) -> int:
+        codes = self._category_codes[col]
+        code = codes.get(value)
+        if code is None:
+            code = len(self._categories[col])
+            codes[value] = code
+            self._categories[col].append(value)
+        return code
+
+    def _check_scan_nums(self, scan_nums: np.ndarray):
+        duplicates = self._get_scan_nums().duplicates(scan_nums)
+        if duplicates.shape[0] == 0:
+            values, counts = np.unique(scan_nums, return_counts=True)
+            duplicates = values[counts > 1]
+        if duplicates.shape[0] > 0:
+            err = f"scan number to register in sampling pattern ({int(duplicates.min())}) exists already!"
+            log_module.error(err)
+            raise ValueError(err)
+        self._scan_nums.update(scan_nums)
+
+    def append(self, scan_num: int, slice_num: int, pe_num: int, echo_num: int,
+               acq_type: str = "", echo_type: str = "", echo_type_num: int = -1, nav_acq: bool = False):
+        scan_num = int(scan_num)
+        if scan_num in self._get_scan_nums():
+            err = f"scan number to register in sampling pattern ({scan_num}) exists already!"
+            log_module.error(err)
+            raise ValueError(err)
+        self._reserve(1)
+        idx = self._size
+        self._data["scan_num"][idx] = scan_num
+        self._data["slice_num"][idx] = slice_num
+        self._data["pe_num"][idx] = pe_num
+        self._data["acq_type"][idx] = self._encode("acq_type", acq_type)
+        self._data["echo_num"][idx] = echo_num
+        self._data["echo_type"][idx] = self._encode("echo_type", echo_type)
+        self._data["echo_type_num"][idx] = echo_type_num
+        self._data["nav_acq"][idx] = nav_acq
+        self._get_scan_nums().add(scan_num)
+        self._size += 1
+        self._df_cache = None
+        self._index = None
+        self._version += 1
+        self._maybe_spill()
+
+    def append_columns(self, **columns):
+        """
+        Append many entries at once.
+        :param columns: one array like per column name, missing optional columns are filled with defaults
+        """
+        missing = [col for col in ("scan_num", "slice_num", "pe_num", "echo_num") if col not in columns]
+        if missing:
+            err = f"sampling pattern columns missing: {missing}"
+            log_module.error(err)
+            raise ValueError(err)
+        scan_nums = np.asarray(columns["scan_num"], dtype=np.int64).reshape(-1)
+        num = scan_nums.shape[0]
+        if num == 0:
+            return
+        self._check_scan_nums(scan_nums)
+        self._reserve(num)
+        sl = slice(self._size, self._size + num)
+        for col in self.columns:
+            values = columns.get(col, self.defaults.get(col))
+            if col in self.str_columns:
+                values = np.broadcast_to(np.asarray(values, dtype=object), (num,))
+                uniques, inverse = np.unique(values.astype(str), return_inverse=True)
+                codes = np.array([self._encode(col, u) for u in uniques.tolist()], dtype=np.int32)
+                self._data[col][sl] = codes[inverse.reshape(-1)]
+            else:
+                self._data[col][sl] = np.broadcast_to(np.asarray(values), (num,))
+        self._size += num
+        self._df_cache = None
+        self._index = None
+        self._version += 1
+        self._maybe_spill()
+
+    def extend(self, entries: typing.Iterable[dict]):
+        """
+        Append a list of entry dicts, keys as in the sampling pattern columns.
+        """
+        entries = list(entries)
+        if not entries:
+            return
+        columns = {}
+        for col in self.columns:
+            default = self.defaults.get(col)
+            columns[col] = [e.get(col, default) for e in entries]
+        self.append_columns(**columns)
+
+    def spill_to(self, writer, chunk_size: int = 65536):
+        """
+        Spill entries to a stream writer whenever chunk_size rows are in memory, which bounds memory use.
+        Rows held already are written right away, the scan numbers of the duplicate check spill alongside.
+        Reading columns reads the spilled rows back from the stream, the resolved rows are kept and
+        only rows spilled since the last read are read again.
+        :param writer: SamplingPatternStreamWriter
+        :param chunk_size: number of rows per chunk
+        """
+        if self._spill is not None:
+            err = f"sampling pattern spills to {self._spill.path} already"
+            log_module.error(err)
+            raise ValueError(err)
+        # scan numbers of spilled rows stay known for the duplicate check
+        self._get_scan_nums().spill_to(writer.path)
+        self._spill = writer
+        self._spill_chunk_size = max(int(chunk_size), 1)
+        self.flush()
+
+    def _maybe_spill(self):
+        if self._spill is not None and self._size >= self._spill_chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the rows in memory as one chunk to the stream, no op if not spilling.
+        """
+        if self._spill is None or self._size == 0:
+            return
+        arrays = {col: self._data[col][:self._size] for col in self.columns}
+        meta = {"categories": {col: list(self._categories[col]) for col in self.str_columns}}
+        self._spill.write_chunk(arrays, meta)
+        self._num_spilled += self._size
+        self._size = 0
+        self._df_cache = None
+        if not all(data.flags.writeable for data in self._data.values()):
+            self._data = {col: np.empty(self._capacity, dtype=self._column_dtype(col)) for col in self.columns}
+
+    def close_spill(self, load: bool = True):
+        """
+        Write the remaining rows, close the stream writer and stop spilling.
+        :param load: read all entries back into memory, otherwise the buffer is emptied
+        """
+        if self._spill is None:
+            return
+        self.flush()
+        source = self._resolved() if load else None
+        self._spill.close()
+        self._spill = None
+        self._num_spilled = 0
+        self._scan_nums.close_spill()
+        self._resolved_cache = None
+        self._resolved_reader = None
+        self._resolved_version = -1
+        if load:
+            self._data = source._data
+            self._size = source._size
+            self._capacity = source._capacity
+        else:
+            self.clear()
+
+    def _resolved(self) -> "SamplingPatternBuffer":
+        # all rows in one buffer, spilled rows are read back from the stream
+        if self._num_spilled == 0:
+            return self
+        if self._resolved_version == self._version:
+            return self._resolved_cache
+        self.flush()
+        if self._resolved_reader is None:
+            # imported here, the stream module builds on this one
+            from .sampling_stream import SamplingPatternStreamReader
+            self._resolved_reader = SamplingPatternStreamReader(self._spill.path)
+        new = self._resolved_reader.read_new()
+        if self._resolved_cache is None:
+            self._resolved_cache = new
+        else:
+            self._resolved_cache._append_rows(new)
+        # categories only grow, the codes of earlier chunks stay valid
+        self._resolved_cache._categories = {col: list(self._categories[col]) for col in self.str_columns}
+        self._resolved_version = self._version
+        return self._resolved_cache
+
+    def _append_rows(self, other: "SamplingPatternBuffer"):
+        # append the raw rows of a buffer sharing the categories, no duplicate check
+        num = other._size
+        self._reserve(num)
+        for col in self.columns:
+            self._data[col][self._size:self._size + num] = other._data[col][:num]
+        self._size += num
+        self._df_cache = None
+        self._index = None
+        self._version += 1
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        Get a read only view of a column, string columns are decoded.
+        """
+        if name in self.str_columns:
+            return self.categories(name)[self.codes(name)]
+        return self.codes(name)
+
+    def codes(self, name: str) -> np.ndarray:
+        source = self._resolved()
+        data = source._data[name][:source._size]
+        data.flags.writeable = False
+        return data
+
+    def categories(self, name: str) -> np.ndarray:
+        return np.array(self._categories[name], dtype=object)
+
+    def clear(self):
+        if self._spill is not None:
+            err = f"can not clear sampling pattern while spilling to {self._spill.path}, close the spill first"
+            log_module.error(err)
+            raise ValueError(err)
+        self._size = 0
+        # fresh arrays, the current ones might be read only memory maps
+        self._data = {col: np.empty(self._capacity, dtype=self._column_dtype(col)) for col in self.columns}
+        self._categories = {col: [] for col in self.str_columns}
+        self._category_codes = {col: {} for col in self.str_columns}
+        self._scan_nums = ScanNumberSet()
+        self._df_cache = None
+        self._index = None
+        self._version += 1
+
+    def get_index(self) -> SamplingPatternIndex:
+        """
+        Get the lookup index, built once when first requested after the last change of the pattern.
+        """
+        if self._index is None:
+            source = self._resolved()
+            self._index = SamplingPatternIndex.build(
+                scan_num=source.codes("scan_num"), slice_num=source.codes("slice_num"),
+                echo_num=source.codes("echo_num"), pe_num=source.codes("pe_num"),
+                acq_type_codes=source.codes("acq_type"), acq_type_categories=self._categories["acq_type"],
+                nav_acq=source.codes("nav_acq")
+            )
+        return self._index
+
+    def to_dataframe(self) -> "pd.DataFrame":
+        """
+        DataFrame of the pattern indexed by scan number. The frame is a copy,
+        edits to it do not change the buffer, set the edited frame back to store them.
+        """
+        if self._df_cache is None:
+            source = self._resolved()
+            self._df_cache = pd.DataFrame(
+                {col: source.column(col).copy() for col in self.columns if col != "scan_num"},
+                index=pd.Index(source.column("scan_num").copy(), name="scan_num")
+            )
+        return _detached(self._df_cache)
+
+    def to_arrays(self) -> typing.Tuple[typing.Dict[str, np.ndarray], dict]:
+        """
+        Get the raw column arrays (string columns as codes) and the metadata needed to rebuild the buffer.
+        The lookup index is included (and built if needed), hence loading does not rebuild it.
+        """
+        source = self._resolved()
+        arrays = {col: source._data[col][:source._size] for col in self.columns}
+        meta = {"categories": {col: list(self._categories[col]) for col in self.str_columns}}
+        if len(self) > 0:
+            index_arrays, meta["index"] = self.get_index().to_arrays()
+            arrays.update({f"index.{key}": arr for key, arr in index_arrays.items()})
+        return arrays, meta
+
+    @classmethod
+    def from_arrays(cls, arrays: typing.Dict[str, np.ndarray], meta: dict):
+        """
+        Build a buffer on top of the given column arrays without copying them.
+        The arrays are only copied once the buffer needs to grow, hence read only memory maps can be used.
+        """
+        instance = cls(capacity=1)
+        size = arrays["scan_num"].shape[0]
+        instance._data = {col: arrays[col] for col in cls.columns}
+        instance._size = size
+        instance._capacity = size
+        for col in cls.str_columns:
+            categories = list(meta["categories"][col])
+            instance._categories[col] = categories
+            instance._category_codes[col] = {c: i for i, c in enumerate(categories)}
+        instance._scan_nums = None
+        if "index" in meta:
+            instance._index = SamplingPatternIndex(
+                arrays={key[len("index."):]: arr for key, arr in arrays.items() if key.startswith("index.")},
+                meta=meta["index"], scan_num=instance.codes("scan_num"), pe_num=instance.codes("pe_num"),
+                acq_type_categories=instance._categories["acq_type"]
+            )
+        return instance
+
+    @classmethod
+    def from_dataframe(cls, df: "pd.DataFrame"):
+        instance = cls(capacity=max(df.shape[0], 1))
+        if df.shape[0] == 0:
+            return instance
+        columns = {col: df[col].to_numpy() for col in cls.columns if col in df.columns}
+        if "scan_num" not in columns:
+            # sampling pattern set from list is indexed by scan number
+            columns["scan_num"] = df.index.to_numpy()
+        for col in cls.int_columns:
+            if col in columns:
+                columns[col] = columns[col].astype(np.int64)
+        for col in cls.bool_columns:
+            if col in columns:
+                columns[col] = columns[col].astype(bool)
+        instance.append_columns(**columns)
+        return instance
+
+    @classmethod
+    def from_value(cls, value):
+        if isinstance(value, cls):
+            return value
+        if value is None:
+            return cls()
+        if isinstance(value, dict):
+            value = pd.DataFrame.from_dict(value)
+        if isinstance(value, pd.DataFrame):
+            return cls.from_dataframe(value)
+        err = f"can not set sampling pattern from type {type(value)}"
+        log_module.error(err)
+        raise TypeError(err)
+
+
+class KTrajectoryStore:
+    """
+    Ragged array storage of k-space read trajectories.
+    The samples of all acquisitions live in two contiguous float arrays,
+    an offsets array and the identifier index give the range of each acquisition.
+    """
+    columns: typing.Tuple[str, ...] = ("acquisition", "adc_sampling_num", "k_traj_position")
+
+    def __init__(self, capacity: int = 1024):
+        self._size: int = 0
+        self._capacity: int = max(int(capacity), 1)
+        self._adc_sampling_num: np.ndarray = np.empty(self._capacity, dtype=np.float64)
+        self._k_traj_position: np.ndarray = np.empty(self._capacity, dtype=np.float64)
+        self._offsets: typing.List[int] = [0]
+        self._identifiers: typing.List[str] = []
+        self._index: typing.Dict[str, int] = {}
+        self._df_cache: typing.Optional["pd.DataFrame"] = None
+
+    def __len__(self) -> int:
+        return len(self._identifiers)
+
+    def __contains__(self, identifier: str) -> bool:
+        return identifier in self._index
+
+    @property
+    def identifiers(self) -> typing.List[str]:
+        return list(self._identifiers)
+
+    @property
+    def offsets(self) -> np.ndarray:
+        return np.array(self._offsets, dtype=np.int64)
+
+    @property
+    def num_samples(self) -> int:
+        return self._size
+
+    @staticmethod
+    def _split(trajectory: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+        trajectory = np.asarray(trajectory)
+        if trajectory.shape.__len__() > 1:
+            return trajectory[:, 0], trajectory[:, 1]
+        return np.arange(trajectory.shape[0]), trajectory
+
+    def _reserve(self, num: int):
+        if self._size + num <= self._capacity:
+            return
+        capacity = max(2 * self._capacity, self._size + num)
+        for name in ("_adc_sampling_num", "_k_traj_position"):
+            data = np.empty(capacity, dtype=np.float64)
+            data[:self._size] = self.__getattribute__(name)[:self._size]
+            self.__setattr__(name, data)
+        self._capacity = capacity
+
+    def _add_identifier(self, identifier: str, num: int):
+        if identifier in self._index:
+            err = f"trajectory for acquisition {identifier} registered already!"
+            log_module.error(err)
+            raise ValueError(err)
+        self._index[identifier] = len(self._identifiers)
+        self._identifiers.append(identifier)
+        self._offsets.append(self._offsets[-1] + num)
+
+    def register(self, identifier: str, trajectory: np.ndarray):
+        self.register_many({identifier: trajectory})
+
+    def register_many(self, trajectories: typing.Union[dict, typing.Iterable[typing.Tuple[str, np.ndarray]]]):
+        """
+        Register several trajectories with one allocation.
+        As for the former DataFrame, registering an identifier again appends the samples to its trajectory.
+        :param trajectories: dict or iterable of (identifier, trajectory) pairs.
+            Trajectories either 1D k-space positions or 2D with columns (adc sampling number, k-space position)
+        """
+        if isinstance(trajectories, dict):
+            trajectories = trajectories.items()
+        # pieces per identifier in order of first appearance
+        pieces: typing.Dict[str, typing.List[typing.Tuple[np.ndarray, np.ndarray]]] = {}
+        for identifier, trajectory in trajectories:
+            pieces.setdefault(identifier, []).append(self._split(trajectory))
+        identifiers = []
+        samples = []
+        positions = []
+        for identifier, parts in pieces.items():
+            adc_samples = parts[0][0] if len(parts) == 1 else np.concatenate([p[0] for p in parts])
+            k_pos = parts[0][1] if len(parts) == 1 else np.concatenate([p[1] for p in parts])
+            if identifier in self._index:
+                self._append_to(identifier, adc_samples, k_pos)
+                continue
+            identifiers.append(identifier)
+            samples.append(adc_samples)
+            positions.append(k_pos)
+        num = sum(s.shape[0] for s in samples)
+        self._reserve(num)
+        if num > 0:
+            sl = slice(self._size, self._size + num)
+            np.concatenate(samples, out=self._adc_sampling_num[sl], casting="unsafe")
+            np.concatenate(positions, out=self._k_traj_position[sl], casting="unsafe")
+        for identifier, adc_samples in zip(identifiers, samples):
+            self._add_identifier(identifier, adc_samples.shape[0])
+        self._size += num
+        self._df_cache = None
+
+    def _append_to(self, identifier: str, adc_samples: np.ndarray, k_pos: np.ndarray):
+        # samples of later acquisitions move back, O(number of samples)
+        idx = self._index[identifier]
+        num = adc_samples.shape[0]
+        if num == 0:
+            return
+        self._reserve(num)
+        end = self._offsets[idx + 1]
+        for name, values in (("_adc_sampling_num", adc_samples), ("_k_traj_position", k_pos)):
+            data = self.__getattribute__(name)
+            data[end + num:self._size + num] = data[end:self._size]
+            data[end:end + num] = values
+        for i in range(idx + 1, len(self._offsets)):
+            self._offsets[i] += num
+        self._size += num
+        self._df_cache = None
+
+    def get(self, identifier: str) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Get read only views of adc sampling numbers and k-space positions of one acquisition.
+        """
+        idx = self._index.get(identifier)
+        if idx is None:
+            err = f"no trajectory registered for acquisition {identifier}"
+            log_module.error(err)
+            raise KeyError(err)
+        sl = slice(self._offsets[idx], self._offsets[idx + 1])
+        adc_samples = self._adc_sampling_num[sl]
+        k_pos = self._k_traj_position[sl]
+        adc_samples.flags.writeable = False
+        k_pos.flags.writeable = False
+        return adc_samples, k_pos
+
+    def padded(self, identifiers: typing.List[str], fill: float = np.nan,
+               by_adc_sample: bool = False) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Gather the k-space positions of several acquisitions into one 2D array.
+        :param identifiers: acquisitions, one row each
+        :param fill: value for samples past the end of shorter trajectories
+        :param by_adc_sample: place each position in the column of its adc sampling number instead of its
+            sample order, columns of adc samples without registered position get fill.
+            Requires non negative, integer valued and per acquisition unique sampling numbers
+        :return: positions (num identifiers, max number of samples) and number of samples per row
+        """
+        missing = [i for i in identifiers if i not in self._index]
+        if missing:
+            err = f"no trajectory registered for acquisitions {missing}"
+            log_module.error(err)
+            raise KeyError(err)
+        idx = np.array([self._index[i] for i in identifiers], dtype=np.int64)
+        offsets = self.offsets
+        starts = offsets[:-1][idx]
+        num_samples = offsets[1:][idx] - starts
+        width = int(num_samples.max(initial=0))
+        mask = np.arange(width)[None, :] < num_samples[:, None]
+        sample_idx = (starts[:, None] + np.arange(width)[None, :])[mask]
+        if not by_adc_sample:
+            positions = np.full((idx.shape[0], width), fill, dtype=np.float64)
+            positions[mask] = self._k_traj_position[sample_idx]
+            return positions, num_samples
+        adc = self._adc_sampling_num[sample_idx]
+        columns = adc.astype(np.int64)
+        row_of_sample = np.repeat(np.arange(idx.shape[0]), num_samples)
+        if np.any(columns != adc) or np.any(columns < 0):
+            err = "adc sampling numbers need to be non negative integers to place trajectory samples"
+            log_module.error(err)
+            raise ValueError(err)
+        positions = np.full((idx.shape[0], int(columns.max(initial=-1)) + 1), fill, dtype=np.float64)
+        if np.unique(row_of_sample * positions.shape[1] + columns).shape[0] != columns.shape[0]:
+            err = "adc sampling numbers of a trajectory are not unique"
+            log_module.error(err)
+            raise ValueError(err)
+        positions[row_of_sample, columns] = self._k_traj_position[sample_idx]
+        return positions, num_samples
+
+    def to_arrays(self) -> typing.Tuple[typing.Dict[str, np.ndarray], dict]:
+        arrays = {
+            "adc_sampling_num": self._adc_sampling_num[:self._size],
+            "k_traj_position": self._k_traj_position[:self._size],
+            "offsets": self.offsets
+        }
+        return arrays, {"identifiers": list(self._identifiers)}
+
+    @classmethod
+    def from_arrays(cls, arrays: typing.Dict[str, np.ndarray], meta: dict):
+        """
+        Build a store on top of the given arrays without copying them.
+        """
+        instance = cls(capacity=1)
+        size = arrays["adc_sampling_num"].shape[0]
+        instance._adc_sampling_num = arrays["adc_sampling_num"]
+        instance._k_traj_position = arrays["k_traj_position"]
+        instance._size = size
+        instance._capacity = size
+        instance._offsets = arrays["offsets"].tolist()
+        instance._identifiers = list(meta["identifiers"])
+        instance._index = {identifier: i for i, identifier in enumerate(instance._identifiers)}
+        return instance
+
+    def to_dataframe(self) -> "pd.DataFrame":
+        if self._df_cache is None:
+            counts = np.diff(self._offsets)
+            codes = np.repeat(np.arange(len(self._identifiers)), counts)
+            self._df_cache = pd.DataFrame({
+                "acquisition": pd.Categorical.from_codes(codes, categories=self._identifiers),
+                "adc_sampling_num": self._adc_sampling_num[:self._size].copy(),
+                "k_traj_position": self._k_traj_position[:self._size].copy()
+            })
+        return _detached(self._df_cache)
+
+    @classmethod
+    def from_dataframe(cls, df: "pd.DataFrame"):
+        instance = cls(capacity=max(df.shape[0], 1))
+        if df.shape[0] == 0:
+            return instance
+        acquisitions = df["acquisition"].to_numpy()
+        trajectory = np.stack(
+            (df["adc_sampling_num"].to_numpy(dtype=np.float64), df["k_traj_position"].to_numpy(dtype=np.float64)),
+            axis=1
+        )
+        uniques, first, inverse = np.unique(acquisitions.astype(str), return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        # group rows per acquisition in one pass, rows keep their order within a group
+        rows = np.argsort(inverse, kind="stable")
+        groups = np.split(trajectory[rows], np.cumsum(np.bincount(inverse, minlength=uniques.shape[0]))[:-1])
+        # keep order of first appearance
+        instance.register_many((str(uniques[u_idx]), groups[u_idx]) for u_idx in np.argsort(first))
+        return instance
+
+    @classmethod
+    def from_value(cls, value):
+        if isinstance(value, cls):
+            return value
+        if value is None:
+            return cls()
+        if isinstance(value, dict):
+            value = pd.DataFrame.from_dict(value)
+        if isinstance(value, pd.DataFrame):
+            return cls.from_dataframe(value)
+        err = f"can not set k-space trajectories from type {type(value)}"
+        log_module.error(err)
+        raise TypeError(err)
+
+
+class StorageField:
+    """
+    Data descriptor backing a dataclass field by a storage object.
+    Reading gives a DataFrame copy of the storage, setting accepts a storage object, a DataFrame or a dict.
+    In place edits of the read DataFrame are not stored, eg. edit and set it back:
+    df = section.sampling_pattern; df.loc[scan_num, "pe_num"] = 5; section.sampling_pattern = df
+    """
+    def __init__(self, storage_cls):
+        self.storage_cls = storage_cls
+        self.name: str = ""
+        self.storage_name: str = ""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.storage_name = f"_{name}_storage"
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            # dataclass queries the default value on the class, default is an empty storage
+            return None
+        return self.get_storage(obj).to_dataframe()
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.storage_name] = self.storage_cls.from_value(value)
+
+    def get_storage(self, obj):
+        storage = obj.__dict__.get(self.storage_name)
+        if storage is None:
+            storage = self.storage_cls()
+            obj.__dict__[self.storage_name] = storage
+        return storage
+
+    @staticmethod
+    def storage_of(obj, name: str):
+        # class attribute access goes through __get__, hence look up the descriptor in the class dicts
+        for klass in type(obj).__mro__:
+            attr = klass.__dict__.get(name)
+            if isinstance(attr, StorageField):
+                return attr.get_storage(obj)
+        err = f"{type(obj).__name__} has no storage backed field {name}"
+        log_module.error(err)
+        raise AttributeError(err)
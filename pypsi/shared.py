@@ -0,0 +1,132 @@
+"""
+Arrays shared between processes without pickling.
+A published block is a binary container placed on a memory backed file system (/dev/shm if available),
+every process attaching to it memory-maps the same pages, nothing is copied per process.
+Processes exchange a small SharedHandle (the block path) instead of the arrays.
+Parameter classes are published whole via publish / attach, their numpy backed members become views.
+"""
+import dataclasses as dc
+import functools
+import logging
+import os
+import pathlib as plib
+import tempfile
+import typing
+import uuid
+import weakref
+
+import numpy as np
+
+from .parameters import binary
+
+log_module = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=1)
+def shared_memory_dir() -> plib.Path:
+    """
+    Directory of the shared blocks, /dev/shm (tmpfs) if usable, otherwise the temp directory
+    (pages are still shared via the page cache, but may be written back to disk).
+    """
+    shm = plib.Path("/dev/shm")
+    if shm.is_dir() and os.access(shm, os.W_OK):
+        return shm
+    return plib.Path(tempfile.gettempdir())
+
+
+def _unlink(path: str, pid: int):
+    # only the publishing process removes the block, forked children inherit the owner but not the ownership
+    if os.getpid() == pid:
+        plib.Path(path).unlink(missing_ok=True)
+
+
+def remove_on_collect(owner, path: typing.Union[str, plib.Path]) -> weakref.finalize:
+    """
+    Remove the block at path once owner is garbage collected or the interpreter exits,
+    hence blocks of owners that are dropped without close (eg. on exceptions) do not stay in shared memory.
+    :return: finalizer, call it to remove the block early
+    """
+    return weakref.finalize(owner, _unlink, plib.Path(path).as_posix(), os.getpid())
+
+
+@dc.dataclass(frozen=True)
+class SharedHandle:
+    # path of the shared block, the handle is all a worker needs to attach
+    path: str
+
+    def attach(self) -> typing.Tuple[dict, typing.Dict[str, np.ndarray]]:
+        """
+        Map the block read only.
+        :return: meta and arrays, the arrays are read only views into the shared block
+        """
+        return binary.read_container(self.path, mmap=True)
+
+
+class SharedArrays:
+    def __init__(self, arrays: typing.Dict[str, np.ndarray], meta: dict = None, prefix: str = "pypsi"):
+        """
+        Publish arrays into a new shared block, the publishing instance owns the block and removes it on close
+        or when it is garbage collected.
+        :param arrays: arrays to share, keyed by name
+        :param meta: JSON serializable content shared alongside
+        :param prefix: file name prefix of the block
+        """
+        path = shared_memory_dir().joinpath(f"{prefix}_{os.getpid()}_{uuid.uuid4().hex}{binary.BINARY_SUFFIX}")
+        tmp = path.with_suffix(".tmp")
+        # attaching processes never see a partially written block
+        binary.write_container(tmp, meta=meta if meta is not None else {}, arrays=arrays)
+        os.replace(tmp, path)
+        self.handle: SharedHandle = SharedHandle(path=path.as_posix())
+        self.nbytes: int = path.stat().st_size
+        self._finalizer: weakref.finalize = remove_on_collect(self, path)
+        log_module.debug(f"published shared block {path.name} ({self.nbytes / 1024 ** 2:.2f} MB)")
+
+    @staticmethod
+    def allocate(shape: typing.Tuple[int, ...], dtype=np.float64, fill=0,
+                 prefix: str = "pypsi") -> typing.Tuple[plib.Path, np.ndarray]:
+        """
+        Allocate a writable shared array, eg. a preallocated output filled by worker processes.
+        The caller owns the block, register it with remove_on_collect or remove it when done.
+        :return: path of the block and the array mapped in this process, attach others via open_writable
+        """
+        path = shared_memory_dir().joinpath(f"{prefix}_{os.getpid()}_{uuid.uuid4().hex}.npy")
+        out = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=tuple(shape))
+        out[...] = fill
+        return path, out
+
+    @staticmethod
+    def open_writable(path: typing.Union[str, plib.Path]) -> np.ndarray:
+        return np.load(path, mmap_mode="r+")
+
+    def close(self):
+        """
+        Remove the block, processes already attached keep their mappings.
+        """
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def publish(obj, prefix: str = "pypsi") -> SharedArrays:
+    """
+    Publish a parameter dataclass instance (eg. Params) into a shared block.
+    The block is a regular binary container of the instance, scalars go to the header,
+    arrays and array backed storages (sampling pattern, k-trajectories) to the shared data.
+    :return: owner of the block, pass its handle to other processes and close it when all are done,
+        the block is removed as well once the owner is garbage collected
+    """
+    scalars, storages, arrays = binary.pack(obj)
+    meta = {"class": type(obj).__qualname__, "fields": scalars, "storages": storages}
+    return SharedArrays(arrays, meta=meta, prefix=prefix)
+
+
+def attach(cls, handle: SharedHandle):
+    """
+    Build an instance of cls from a published block, no data is copied or unpickled.
+    Array members are read only views into the shared block, writing to them raises.
+    """
+    return binary.load(cls, handle.path, mmap=True)
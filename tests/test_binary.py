@@ -0,0 +1,37 @@
+import numpy as np
+
+from pypsi.config import Params
+from pypsi.parameters import binary, PypulseqParameters
+
+
+def _params() -> Params:
+    params = Params()
+    params.pypulseq = PypulseqParameters(resolution_base=93, bandwidth=417.4485, oversampling=1)
+    params.pulse.excitation.amplitude = np.hanning(params.pulse.excitation.num_samples)
+    sampling = params.sampling_k_traj
+    sampling.register_trajectory(np.linspace(-1.0, 1.0, 64), identifier="se")
+    sampling.get_sampling_pattern_buffer().append_columns(
+        scan_num=np.arange(500), slice_num=np.arange(500) % 4, pe_num=np.arange(500) % 93,
+        echo_num=np.arange(500) % 8, acq_type="se"
+    )
+    return params
+
+
+def test_binary_round_trip(tmp_path):
+    params = _params()
+    path = tmp_path.joinpath("params.pypsi")
+    params.save_binary(path)
+    for loaded in (Params.load_binary(path), Params.load_binary(path, mmap=False), Params.load_lazy(path)):
+        assert binary.digest(loaded) == binary.digest(params)
+        assert loaded.pypulseq.bandwidth == params.pypulseq.bandwidth
+        assert loaded.pypulseq.dwell == params.pypulseq.dwell
+        assert np.array_equal(loaded.pypulseq.te, params.pypulseq.te)
+        assert loaded.sampling_k_traj.sampling_pattern.equals(params.sampling_k_traj.sampling_pattern)
+        assert loaded.sampling_k_traj.k_trajectories.equals(params.sampling_k_traj.k_trajectories)
+
+
+def test_shared_round_trip():
+    params = _params()
+    with params.publish_shared() as owner:
+        attached = Params.attach_shared(owner.handle)
+        assert binary.digest(attached) == binary.digest(params)
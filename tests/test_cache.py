@@ -0,0 +1,44 @@
+import argparse
+import json
+
+from pypsi.cache import ParamsCache
+from pypsi.config import Params, Config, XConfig
+from pypsi.parameters import binary
+
+
+def _args(tmp_path) -> argparse.Namespace:
+    # raw protocol inputs for which deriving twice changes bandwidth and dwell
+    config_file = tmp_path.joinpath("config.json")
+    config_file.write_text(json.dumps({"pypulseq": {"resolution_base": 93, "bandwidth": 417.4485, "oversampling": 1}}))
+    return argparse.Namespace(
+        config=Config(config_file=config_file.as_posix(), cache_dir=tmp_path.joinpath("cache").as_posix()),
+        extra_files=XConfig()
+    )
+
+
+def test_cache_hit_equals_miss(tmp_path):
+    args = _args(tmp_path)
+    uncached = Params._from_cli(args)
+    miss = Params.from_cli(args)
+    hit = Params.from_cli(args)
+    lazy_hit = Params.from_cli(args, lazy=True)
+    assert len(ParamsCache(args.config.cache_dir).entries()) == 1
+    assert hit.pypulseq.bandwidth == miss.pypulseq.bandwidth == uncached.pypulseq.bandwidth
+    assert hit.pypulseq.dwell == miss.pypulseq.dwell == uncached.pypulseq.dwell
+    assert binary.digest(hit) == binary.digest(miss) == binary.digest(uncached) == binary.digest(lazy_hit)
+
+
+def test_cache_entry_evicted_after_lookup(tmp_path):
+    args = _args(tmp_path)
+
+    class EvictingCache(ParamsCache):
+        def get(self, key):
+            entry = super().get(key)
+            if entry is not None:
+                entry.unlink()
+            return entry
+
+    cache = EvictingCache(args.config.cache_dir)
+    miss = Params.from_cli(args, cache=cache)
+    evicted = Params.from_cli(args, cache=cache)
+    assert binary.digest(evicted) == binary.digest(miss)
@@ -0,0 +1,36 @@
+import argparse
+import dataclasses as dc
+
+import pytest
+
+from pypsi.config import Params, Config, XConfig
+
+
+@dc.dataclass
+class ExtendedParams(Params):
+    extra: int = 0
+
+
+def test_subclass_from_cli_with_extra_file(tmp_path):
+    specs_file = tmp_path.joinpath("specs.json")
+    ExtendedParams().specs.save_json(specs_file)
+    args = argparse.Namespace(config=Config(), extra_files=XConfig(scanner_specs_file=specs_file.as_posix()))
+    for lazy in (False, True):
+        params = ExtendedParams.from_cli(args, lazy=lazy)
+        assert isinstance(params, ExtendedParams)
+        assert not params.is_loaded("pulse")
+
+
+@pytest.mark.parametrize("suffix", [".pypsi", ".json"])
+def test_subclass_load_lazy(tmp_path, suffix):
+    path = tmp_path.joinpath(f"params{suffix}")
+    params = ExtendedParams(extra=5)
+    if suffix == ".pypsi":
+        params.save_binary(path)
+    else:
+        params.save_json(path)
+    loaded = ExtendedParams.load_lazy(path)
+    assert loaded.extra == 5
+    assert not loaded.is_loaded("pulse")
+    assert loaded.pulse.excitation.num_samples == params.pulse.excitation.num_samples
+    assert loaded.is_loaded("pulse")
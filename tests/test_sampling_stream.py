@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from pypsi.parameters.sampling_stream import SamplingPatternStreamWriter, SamplingPatternStreamReader
+from pypsi.parameters.storage import SamplingPatternBuffer
+
+
+def _append(buffer: SamplingPatternBuffer, scan_nums):
+    buffer.append_columns(scan_num=scan_nums, slice_num=0, pe_num=0, echo_num=0, acq_type="se")
+
+
+def test_duplicates_detected_across_spills(tmp_path):
+    buffer = SamplingPatternBuffer()
+    buffer.spill_to(SamplingPatternStreamWriter(tmp_path.joinpath("pattern.psp")), chunk_size=1000)
+    for start in range(0, 20000, 500):
+        _append(buffer, np.arange(start, start + 500))
+    buffer.append(scan_num=20000, slice_num=0, pe_num=0, echo_num=0)
+    # spilled, pending and new rows, and duplicates within one batch
+    for scan_nums in ([5], [19999], [20000], [30000, 30000], [30001, 123]):
+        with pytest.raises(ValueError):
+            _append(buffer, scan_nums)
+    with pytest.raises(ValueError):
+        buffer.append(scan_num=777, slice_num=0, pe_num=0, echo_num=0)
+    assert len(buffer) == 20001
+    assert np.array_equal(buffer.codes("scan_num"), np.arange(20001))
+    buffer.close_spill(load=True)
+    with pytest.raises(ValueError):
+        _append(buffer, [10])
+    _append(buffer, [20001])
+    assert len(buffer) == 20002
+    assert len(SamplingPatternStreamReader(tmp_path.joinpath("pattern.psp")).read_all()) == 20001
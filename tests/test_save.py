@@ -0,0 +1,17 @@
+import numpy as np
+
+from pypsi.config import Params
+
+
+def test_save_as_subclasses_skips_unchanged(tmp_path):
+    params = Params()
+    params.sampling_k_traj.get_sampling_pattern_buffer().append_columns(
+        scan_num=np.arange(100), slice_num=0, pe_num=0, echo_num=0
+    )
+    written = params.save_as_subclasses(tmp_path)
+    assert sorted(written) == sorted(params._d_to_set.values())
+    assert params.save_as_subclasses(tmp_path) == []
+    params.specs.b_0 = 7.0
+    assert params.save_as_subclasses(tmp_path) == ["specs"]
+    assert sorted(params.save_as_subclasses(tmp_path, force=True)) == sorted(written)
+    assert tmp_path.joinpath(params.complete_marker_name).is_file()